@@ -0,0 +1,204 @@
+import asyncio
+import argparse
+import functools
+import time
+
+from async_reliable_udp import start_server, open_connection
+from transport_stats import Histogram, render_prometheus
+from static_files import StaticFiles
+from prefork import Supervisor, STATS_INTERVAL
+from http_message import (HTTPParser, HTTPParseError, read_message_async, read_raw_message_async, status_line,
+                          render_headers, finish_head, error_response)
+
+READ_SIZE = 64 * 1024
+
+class AsyncHTTPServer:
+    def __init__(self, host='localhost', port=8080, loss_prob=0.0, mss=None, root=None, sock=None):
+        # With a document root, GET/HEAD serve files from it; without one, pages are synthesized
+        self.files = StaticFiles(root) if root else None
+        self.host = host
+        self.port = port
+        self.loss_prob = loss_prob
+        self.mss = mss
+        self.sock = sock
+        self.endpoint = None
+        self.requests = 0
+        self.request_latency = Histogram()
+        # Set in a prefork worker, so /metrics reports the whole cluster rather than this process
+        self.cluster = None
+
+    def stats(self):
+        stats = self.endpoint.stats() if self.endpoint is not None else {}
+        stats.update(requests=self.requests, request_latency_seconds=self.request_latency.snapshot())
+        if self.files is not None:
+            stats.update(self.files.stats())
+        return stats
+
+    async def start(self):
+        self.endpoint = await start_server(self.handle_connection, self.host, self.port,
+                                           loss_prob=self.loss_prob, mss=self.mss, sock=self.sock)
+
+    async def serve_forever(self):
+        await self.start()
+        print("Async HTTP Server started.")
+        if self.cluster is None:
+            await asyncio.Event().wait()
+        # Stats are read on the loop, so the worker's snapshots are published from here rather than a thread
+        while True:
+            self.cluster.publish()
+            await asyncio.sleep(STATS_INTERVAL)
+
+    async def handle_connection(self, reader, writer):
+        parser = HTTPParser()
+        read = functools.partial(reader.read, READ_SIZE)
+        while True:
+            try:
+                request = await read_message_async(parser, read)
+            except HTTPParseError as e:
+                print("Server error:", e)
+                writer.write(error_response(e))
+                await writer.wait_closed()
+                break
+            if request is None:
+                # The client shut down its side, or the endpoint reaped the connection: our FIN ends it
+                await writer.wait_closed()
+                break
+            started = time.perf_counter()
+            keep_alive = request.keep_alive
+            try:
+                head, body = self.respond(request)
+            except Exception as e:
+                # e.g. a file that can't be read: answer and close rather than leave the client waiting
+                print(f"[INFO] {request.method} {request.target} failed: {e!r}")
+                writer.write(error_response(HTTPParseError(500, "Internal Server Error")))
+                await writer.wait_closed()
+                break
+            writer.write(finish_head(head, keep_alive))
+            writer.write(body)
+            await writer.drain()
+            self.requests += 1
+            self.request_latency.observe(time.perf_counter() - started)
+            if not keep_alive:
+                await writer.wait_closed()
+                break
+
+    def respond(self, request):
+        # (head, body) for one request; head lacks the Connection header and the terminating blank line
+        method, path = request.method, request.target
+        content_type = "text/html"
+        if method == 'GET' and path == "/metrics":
+            content = render_prometheus(self.cluster.stats() if self.cluster is not None else self.stats())
+            content_type = "text/plain; version=0.0.4"
+            status = 200
+        elif self.files is not None and method in ('GET', 'HEAD'):
+            return self.files.respond(method, path, request.headers)
+        elif method == 'GET':
+            content = f"<html><body><h1>You requested {path}</h1></body></html>"
+            status = 200
+        elif method == 'POST':
+            content = f"<html><body><h1>POST Received to {path} ({len(request.body)} bytes)</h1></body></html>"
+            status = 200
+        else:
+            content = "<html><body><h1>404 Not Found</h1></body></html>"
+            status = 404
+        body = content.encode()
+        return status_line(status) + render_headers([("Content-Length", len(body)), ("Content-Type", content_type)]), body
+
+class AsyncHTTPClient:
+    def __init__(self, server_addr, loss_prob=0.0, mss=None):
+        self.server_addr = server_addr
+        self.loss_prob = loss_prob
+        self.mss = mss
+        self.reader = None
+        self.writer = None
+        self.parser = None
+
+    async def connect(self, early_data=b""):
+        host, port = self.server_addr
+        self.reader, self.writer = await open_connection(host, port, loss_prob=self.loss_prob, mss=self.mss,
+                                                         early_data=early_data)
+        # One parser per connection: bytes read past a response belong to the next one
+        self.parser = HTTPParser(response=True, max_body_bytes=None)
+
+    async def read_response(self):
+        # The next response as received, head and body; b"" if the server closed the connection
+        return await read_raw_message_async(self.parser, functools.partial(self.reader.read, READ_SIZE))
+
+    async def request(self, request):
+        if self.writer is None:
+            await self.connect()
+        self.writer.write(request.encode() if isinstance(request, str) else request)
+        await self.writer.drain()
+        return await self.read_response()
+
+    async def get(self, path):
+        request = f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode()
+        if self.writer is None:
+            # Not connected yet: on a resumed session the GET rides in the SYN
+            await self.connect(early_data=request)
+            return await self.read_response()
+        return await self.request(request)
+
+    async def post(self, path, body="", content_type="text/plain"):
+        body = body.encode() if isinstance(body, str) else body
+        head = (
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: localhost\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Content-Type: {content_type}\r\n\r\n"
+        )
+        return await self.request(head.encode() + body)
+
+    async def close(self):
+        await self.writer.wait_closed()
+
+async def run_clients(server_addr, clients, requests, loss_prob):
+    async def one_client():
+        client = AsyncHTTPClient(server_addr, loss_prob=loss_prob)
+        ok = 0
+        for i in range(requests):
+            response = await client.get(f"/item/{i}")
+            ok += response.startswith(b"HTTP/1.1 200 OK")
+        await client.close()
+        return ok
+
+    start = time.time()
+    results = await asyncio.gather(*(one_client() for _ in range(clients)))
+    elapsed = time.time() - start
+    print(f"[ASYNC] {clients} clients x {requests} requests: {sum(results)}/{clients * requests} OK "
+          f"in {elapsed:.2f}s ({clients * requests / elapsed:.1f} req/s)")
+
+def run_worker(sock, cluster, **kwargs):
+    # Prefork worker entry point: one event loop per process
+    server = AsyncHTTPServer(sock=sock, **kwargs)
+    cluster.attach(server.stats)
+    server.cluster = cluster
+    asyncio.run(server.serve_forever())
+
+async def main(args):
+    if args.role == "server":
+        await AsyncHTTPServer(port=args.port, loss_prob=args.loss, root=args.root).serve_forever()
+    elif args.clients > 1:
+        await run_clients(('localhost', args.port), args.clients, args.requests, args.loss)
+    else:
+        client = AsyncHTTPClient(('localhost', args.port), loss_prob=args.loss)
+        print("Received:\n", (await client.get("/index.html")).decode(errors="replace"))
+        print("Received:\n", (await client.post("/submit", "name=Project")).decode(errors="replace"))
+        await client.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("role", choices=["server", "client"], help="Run as server or client")
+    parser.add_argument("--loss", type=float, default=0.1, help="Packet loss probability")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--clients", type=int, default=1, help="Concurrent connections (client role)")
+    parser.add_argument("--requests", type=int, default=10, help="Requests per connection when --clients > 1")
+    parser.add_argument("--root", default=None, help="Document root to serve files from (server role)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the port via SO_REUSEPORT (server role)")
+    args = parser.parse_args()
+    if args.role == "server" and args.workers > 1:
+        worker = functools.partial(run_worker, loss_prob=args.loss, root=args.root)
+        Supervisor(worker, ('localhost', args.port), args.workers).serve_forever()
+    else:
+        asyncio.run(main(args))
@@ -0,0 +1,628 @@
+import asyncio
+import random
+import time
+
+from packet_codec import make_packet, parse_packet, peek_conn_id, pack_sack, unpack_sack
+from rtt_estimator import RTTEstimator
+from congestion_control import CongestionControl
+from reliable_stream import mss_for_mtu, checked_mss, DEFAULT_MTU
+from net_emulator import Impairments, ImpairedTransport
+from batched_io import tune_buffers
+from transport_stats import ConnectionStats, aggregate
+from handshake import ClientHandshake, HandshakeKeys, OvertakenPackets, COOKIE, TICKET_SIZE, split_syn
+from lifecycle import (Lifecycle, TimerWheel, MAX_RETRIES, MAX_FIN_RTO, ESTABLISHED, CLOSE_WAIT, TIME_WAIT,
+                       TIME_WAIT_PERIOD, FIN_WAIT_TIMEOUT, KEEPALIVE_IDLE, TICK, PROBE, IDLE, DEAD, ABORT)
+from reliable_udp_sliding_window import (TIMEOUT, WINDOW_SIZE, RECV_WINDOW, MAX_SEQ, MAX_FIN_RETRIES, ACK_EVERY,
+                                         ACK_DELAY, SYN, ACK, FIN, PSH, sack_blocks)
+
+# Same wire protocol as ReliableUDP_GBN, so async and threaded peers interoperate.
+# Every timer is a loop.call_later handle; nothing here blocks or spawns threads.
+
+class AsyncConnection:
+    def __init__(self, endpoint, addr, conn_id, mss=None):
+        self.endpoint = endpoint
+        self.loop = endpoint.loop
+        self.addr = addr
+        self.conn_id = conn_id
+        self.mss = checked_mss(mss) if mss else mss_for_mtu(DEFAULT_MTU)
+        self.metrics = ConnectionStats()
+        self.rtt = RTTEstimator(initial_rto=TIMEOUT, histogram=self.metrics.rtt)
+        self.cc = CongestionControl(initial_cwnd=WINDOW_SIZE)
+        self.peer_window = RECV_WINDOW
+        # outgoing holds every written-but-unacked segment; next_seq is the next one to transmit
+        self.outgoing = {}
+        self.sent_at = {}
+        self.base = 0
+        self.next_seq = 0
+        self.write_seq = 0
+        self.high_seq = 0
+        self.sacked = set()
+        self.rexmitted = set()
+        self.expected_seq = 0
+        self.ooo = {}
+        self.unacked = 0
+        self.timer = None
+        self.ack_timer = None
+        # Bytes fed to the reader that the application hasn't read yet
+        self.unread = 0
+        self.reader = ReliableStreamReader(self)
+        self.writer = ReliableStreamWriter(self)
+        self.connected = self.loop.create_future()
+        self.handshake = ClientHandshake(addr, conn_id)
+        # Server side: set by the endpoint, the answer to a retransmitted SYN whose SYN-ACK was lost
+        self.syn_ack = None
+        self.fin_acked = self.loop.create_future()
+        self.drained = []
+        self.lifecycle = Lifecycle()
+        # Consecutive timeouts without an ACK moving base
+        self.retries = 0
+        self.closed = False
+
+    def _send(self, packet):
+        self.endpoint.transport.sendto(packet, self.addr)
+
+    def handle_packet(self, packet):
+        parsed = parse_packet(packet)
+        if parsed is None:
+            self.metrics.checksum_failures += 1
+            return
+        seq, ack, flags, window, payload = parsed
+        self.lifecycle.last_heard = time.monotonic()
+        if flags & SYN:
+            self.peer_window = window
+            if flags & ACK:
+                self._send(self.handshake.on_syn_ack(ack, payload, RECV_WINDOW))
+                self._set_connected()
+            elif self.syn_ack is not None:
+                self._send(self.syn_ack)
+            return
+        # Same handshake rules as ReliableUDP_GBN.handle_packet
+        self.handshake.confirmed()
+        if flags & COOKIE:
+            return
+        if flags & FIN:
+            self._handle_fin(flags)
+        elif flags & ACK:
+            self._handle_ack(ack, window, payload)
+        else:
+            self._handle_data(seq, flags, payload)
+
+    def accept_early_data(self, payload):
+        # Server side: segment 0 came in a resumed SYN, and the SYN-ACK acknowledges it
+        self.metrics.segments_received += 1
+        self.reader.feed_data(payload)
+        self.expected_seq = 1
+
+    def _set_connected(self):
+        if not self.connected.done():
+            self.connected.set_result(True)
+            self.endpoint.connection_established(self)
+
+    def _handle_fin(self, flags):
+        # Half-close as in ReliableUDP_GBN._handle_fin; the connection is let go once it leaves the open states
+        if flags & ACK:
+            self.lifecycle.on_fin_ack()
+            if not self.fin_acked.done():
+                self.fin_acked.set_result(True)
+        else:
+            self._send(make_packet(0, 0, FIN | ACK, b"", conn_id=self.conn_id))
+            if self.lifecycle.on_fin():
+                self.reader.feed_eof()
+        if not self.lifecycle.is_open() and not self.closed:
+            self._shutdown()
+
+    def _handle_ack(self, ack, window, sack):
+        reopened = not self.peer_window and window
+        self.peer_window = window
+        # Measured against high_seq: after a go-back, a cumulative ACK can cover segments past next_seq
+        outstanding = self.high_seq - self.base
+        offset = (ack - self.base) % MAX_SEQ
+        if offset < outstanding:
+            acked = self.base + offset
+            sent = self.sent_at.get(acked)
+            if sent is not None and not sent[1]:
+                self.rtt.sample(time.monotonic() - sent[0])
+            else:
+                self.rtt.on_new_ack()
+            self.cc.on_ack(offset + 1)
+            for seq in range(self.base, acked + 1):
+                self.outgoing.pop(seq, None)
+                self.sent_at.pop(seq, None)
+                self.sacked.discard(seq)
+                self.rexmitted.discard(seq)
+            self.base = acked + 1
+            self.retries = 0
+            self.next_seq = max(self.next_seq, self.base)
+            self._record_sack(sack)
+            if self.sacked:
+                self._retransmit_holes()
+            self._restart_timer()
+            self._pump()
+            self._wake_drained()
+        elif outstanding and offset == MAX_SEQ - 1:
+            if not window or reopened:
+                # The peer drops what arrives while its window is closed. An answer to a probe shows it is
+                # alive, and the update that reopens the window means resending from base.
+                self.retries = 0
+                if reopened:
+                    self.rexmitted.clear()
+                    self.next_seq = self.base
+                    self._pump()
+                return
+            self.metrics.duplicate_acks += 1
+            self._record_sack(sack)
+            self.cc.on_dup_ack()
+            if self.cc.in_recovery():
+                self._retransmit_holes()
+
+    def _record_sack(self, sack):
+        if not sack:
+            return
+        outstanding = self.high_seq - self.base
+        for start, end in unpack_sack(sack):
+            first = (start - self.base) % MAX_SEQ
+            last = (end - self.base) % MAX_SEQ
+            if first < last <= outstanding:
+                self.sacked.update(range(self.base + first, self.base + last))
+
+    def _retransmit_holes(self):
+        # Same recovery as ReliableUDP_GBN: unSACKed segments below the highest SACKed one, once per timeout
+        top = max(self.sacked) if self.sacked else self.base + 1
+        for seq in range(self.base, min(top, self.next_seq)):
+            if seq in self.sacked or seq in self.rexmitted:
+                continue
+            self.rexmitted.add(seq)
+            self.sent_at[seq] = (time.monotonic(), True)
+            self._send(make_packet(seq % MAX_SEQ, 0, 0, self.outgoing[seq], conn_id=self.conn_id))
+            self.metrics.segments_sent += 1
+            self.metrics.retransmits += 1
+
+    def _handle_data(self, seq, flags, payload):
+        self.metrics.segments_received += 1
+        offset = (seq - self.expected_seq) % MAX_SEQ
+        if offset == 0:
+            if not self._recv_window():
+                # The reader isn't fed past a closed window: drop the segment and repeat the window of 0
+                self._send_ack()
+                return
+            self.reader.feed_data(payload)
+            self.expected_seq += 1
+            filled = False
+            while self.expected_seq in self.ooo:
+                self.reader.feed_data(self.ooo.pop(self.expected_seq))
+                self.expected_seq += 1
+                filled = True
+            self.unacked += 1
+            # Delayed ACK rules as in ReliableUDP_GBN._handle_data
+            if self.unacked >= ACK_EVERY or flags & PSH or filled or self.ooo:
+                self._send_ack()
+            elif self.ack_timer is None:
+                self.ack_timer = self.loop.call_later(ACK_DELAY, self._send_ack)
+            return
+        if offset < RECV_WINDOW:
+            self.ooo.setdefault(self.expected_seq + offset, payload)
+        self._send_ack()
+
+    def _send_ack(self):
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        self.unacked = 0
+        sack = pack_sack(sack_blocks(self.ooo)) if self.ooo else b""
+        self._send(make_packet(0, (self.expected_seq - 1) % MAX_SEQ, ACK, sack, window=self._recv_window(), conn_id=self.conn_id))
+        self.metrics.acks_sent += 1
+
+    def _recv_window(self):
+        # As ReliableUDP_GBN._recv_window: room left for segments the application hasn't read yet
+        return max(RECV_WINDOW - -(-self.unread // self.mss), 0)
+
+    def consumed(self, n):
+        closed = not self._recv_window()
+        self.unread -= n
+        # A window update, so a sender stopped by a window of 0 doesn't wait for its next probe
+        if closed and self._recv_window() and not self.closed:
+            self._send_ack()
+
+    def write(self, data):
+        view = memoryview(data)
+        for i in range(0, len(view), self.mss):
+            self.outgoing[self.write_seq] = bytes(view[i:i + self.mss])
+            self.write_seq += 1
+        self._pump()
+
+    def _pump(self):
+        window = min(self.cc.window(), max(self.peer_window, 1))
+        while self.next_seq < self.write_seq and self.next_seq < self.base + window:
+            seq = self.next_seq
+            self.next_seq += 1
+            if seq in self.sacked:
+                continue
+            # PSH on the last segment written so far, so a request isn't held up by a delayed ACK
+            flags = PSH if seq == self.write_seq - 1 else 0
+            packet = make_packet(seq % MAX_SEQ, 0, flags, self.outgoing[seq], conn_id=self.conn_id)
+            # Below high_seq means this segment already went out once (Karn's algorithm)
+            self.sent_at[seq] = (time.monotonic(), seq < self.high_seq)
+            self._send(packet)
+            self.metrics.segments_sent += 1
+            self.metrics.retransmits += seq < self.high_seq
+        self.high_seq = max(self.high_seq, self.next_seq)
+        self.metrics.window.observe(self.next_seq - self.base)
+        if self.timer is None and self.next_seq > self.base:
+            self.timer = self.loop.call_later(self.rtt.rto, self._on_timeout)
+
+    def _restart_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.next_seq > self.base:
+            self.timer = self.loop.call_later(self.rtt.rto, self._on_timeout)
+
+    def _on_timeout(self):
+        self.timer = None
+        if self.next_seq == self.base:
+            return
+        self.retries += 1
+        if self.retries > MAX_RETRIES:
+            self.abort(ConnectionAbortedError(f"no ACK after {MAX_RETRIES} retransmissions"))
+            return
+        if self.handshake.pending_ack is not None:
+            self._send(self.handshake.pending_ack)
+        self.metrics.timeouts += 1
+        self.rtt.on_timeout()
+        self.cc.on_timeout(self.in_flight())
+        self.rexmitted.clear()
+        self.next_seq = self.base
+        self._pump()
+
+    def stats(self):
+        stats = self.cc.stats()
+        stats.update(rto=self.rtt.rto, peer_window=self.peer_window, in_flight=self.in_flight())
+        stats.update(self.metrics.snapshot())
+        return stats
+
+    def _wake_drained(self):
+        if self.base < self.write_seq:
+            return
+        for waiter in self.drained:
+            if not waiter.done():
+                waiter.set_result(True)
+        self.drained.clear()
+
+    async def drain(self):
+        if self.base >= self.write_seq or self.closed:
+            return
+        waiter = self.loop.create_future()
+        self.drained.append(waiter)
+        await waiter
+
+    async def connect(self, early=b""):
+        # As ReliableUDP_GBN.connect: True if early went in the SYN and the server took it
+        syn = self.handshake.syn(RECV_WINDOW, early)
+        sent_at = time.monotonic()
+        for _ in range(MAX_RETRIES + 1):
+            self._send(syn)
+            try:
+                await asyncio.wait_for(asyncio.shield(self.connected), self.rtt.rto)
+                break
+            except asyncio.TimeoutError:
+                self.rtt.on_timeout()
+                sent_at = None
+        else:
+            error = TimeoutError(f"no SYN-ACK after {MAX_RETRIES} retransmissions")
+            self.abort(error)
+            raise error
+        if sent_at is not None:
+            self.rtt.sample(time.monotonic() - sent_at)
+        if self.handshake.early_accepted:
+            self.base = self.next_seq = self.write_seq = self.high_seq = 1
+        return self.handshake.early_accepted
+
+    async def close(self):
+        # Shuts down our sending side once everything written is ACKed; the endpoint sees the rest of the
+        # teardown through, and keeps the key in TIME_WAIT if we closed first
+        if self.lifecycle.state not in (ESTABLISHED, CLOSE_WAIT):
+            return
+        await self.drain()
+        if not self.lifecycle.close():
+            return
+        if self.ack_timer is not None:
+            # A delayed ACK would trail our FIN
+            self._send_ack()
+        fin = make_packet(0, 0, FIN, b"", conn_id=self.conn_id)
+        for _ in range(MAX_FIN_RETRIES):
+            self._send(fin)
+            try:
+                await asyncio.wait_for(asyncio.shield(self.fin_acked), min(self.rtt.rto, MAX_FIN_RTO))
+                self.endpoint.half_closed(self)
+                return
+            except asyncio.TimeoutError:
+                self.rtt.on_timeout()
+        self.abort(ConnectionAbortedError("FIN was never acknowledged"))
+
+    def abort(self, error):
+        self.lifecycle.abort(error)
+        self.reader.feed_eof()
+        if not self.fin_acked.done():
+            self.fin_acked.set_result(False)
+        if not self.closed:
+            self._shutdown()
+
+    def keepalive(self):
+        # Same probe as ReliableUDP_GBN.keepalive
+        self._send(make_packet((self.base - 1) % MAX_SEQ, 0, 0, b"", conn_id=self.conn_id))
+
+    def in_flight(self):
+        # As ReliableUDP_GBN.in_flight: sent and unacknowledged, not data still waiting for the window
+        return self.high_seq - self.base
+
+    def _shutdown(self):
+        self.closed = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        self._wake_drained()
+        for waiter in self.drained:
+            if not waiter.done():
+                waiter.set_result(False)
+        self.endpoint.connection_closed(self)
+
+class ReliableStreamReader:
+    # The subset of asyncio.StreamReader the HTTP layer needs, counting what the application reads
+    def __init__(self, conn):
+        self.conn = conn
+        self.stream = asyncio.StreamReader()
+
+    def feed_data(self, data):
+        self.conn.unread += len(data)
+        self.stream.feed_data(data)
+
+    def feed_eof(self):
+        self.stream.feed_eof()
+
+    def at_eof(self):
+        return self.stream.at_eof()
+
+    async def read(self, n=-1):
+        return self._taken(await self.stream.read(n))
+
+    async def readline(self):
+        return self._taken(await self.stream.readline())
+
+    async def readuntil(self, separator=b"\n"):
+        return self._taken(await self.stream.readuntil(separator))
+
+    async def readexactly(self, n):
+        return self._taken(await self.stream.readexactly(n))
+
+    def _taken(self, data):
+        self.conn.consumed(len(data))
+        return data
+
+class ReliableStreamWriter:
+    # The subset of asyncio.StreamWriter the HTTP layer needs
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, data):
+        self.conn.write(data)
+
+    async def drain(self):
+        await self.conn.drain()
+
+    def close(self):
+        self.conn.loop.create_task(self.conn.close())
+
+    async def wait_closed(self):
+        await self.conn.close()
+
+    def is_closing(self):
+        # Also once the peer has closed its side: a pooled session in that state can't take another request
+        return self.conn.lifecycle.state != ESTABLISHED
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return self.conn.addr
+        if name == "conn_id":
+            return self.conn.conn_id
+        return default
+
+class ReliableDatagramProtocol(asyncio.DatagramProtocol):
+    # One UDP endpoint; in server mode it demultiplexes (addr, conn_id) into AsyncConnections
+    def __init__(self, loop, client_connected_cb=None, loss_prob=0.0, corrupt_prob=0.0, seed=None, mss=None):
+        self.loop = loop
+        self.client_connected_cb = client_connected_cb
+        self.impairments = Impairments(loss=loss_prob, corrupt=corrupt_prob, seed=seed)
+        self.mss = mss
+        self.transport = None
+        self.connections = {}
+        self.closed_metrics = ConnectionStats()
+        self.accepted = 0
+        self.keys = HandshakeKeys()
+        self.overtaken = OvertakenPackets()
+        self.syn_cookies_sent = 0
+        self.zero_rtt_accepted = 0
+        self.invalid_cookies = 0
+        self.keepalive_timeouts = 0
+        self.idle_timeouts = 0
+        # As in UDPListener: server connections' keepalive/idle checks and TIME_WAIT expiries. The wheel is
+        # turned by one loop timer that only runs while something is set.
+        self.wheel = TimerWheel()
+        self.time_wait = set()
+        self.ticker = None
+
+    def connection_made(self, transport):
+        # asyncio reads one datagram per callback, so only the buffer sizes carry over from batched_io
+        tune_buffers(transport.get_extra_info("socket"))
+        if self.impairments.enabled():
+            transport = ImpairedTransport(transport, self.impairments, self.loop)
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        conn_id = peek_conn_id(data)
+        if conn_id is None:
+            return
+        key = (addr, conn_id)
+        conn = self.connections.get(key)
+        if conn is None:
+            self._new_connection(key, data)
+            return
+        conn.handle_packet(data)
+
+    def _new_connection(self, key, data):
+        # Same stateless handshake as UDPListener._new_connection
+        addr, conn_id = key
+        parsed = parse_packet(data)
+        if parsed is None:
+            return
+        _, _, flags, window, payload = parsed
+        if flags & FIN and not flags & ACK:
+            # Also how a client endpoint in TIME_WAIT answers the server's retransmitted FIN
+            self.transport.sendto(make_packet(0, 0, FIN | ACK, b"", conn_id=conn_id), addr)
+        elif self.client_connected_cb is None:
+            return
+        elif flags & SYN and not flags & ACK:
+            ticket, early = split_syn(payload)
+            # A ticket alone buys nothing: without a request to answer, the client proves its address first
+            if not early or not self.keys.check_ticket(ticket, addr):
+                self.syn_cookies_sent += 1
+                self.transport.sendto(self.keys.syn_ack(addr, conn_id, RECV_WINDOW, False), addr)
+                return
+            self.zero_rtt_accepted += 1
+            conn = self._establish(key, window, accepted=True)
+            conn.accept_early_data(early)
+            self.transport.sendto(conn.syn_ack, addr)
+            conn._set_connected()
+        elif flags & COOKIE and flags & ACK:
+            if not self.keys.check_cookie(payload, addr, conn_id):
+                self.invalid_cookies += 1
+                return
+            conn = self._establish(key, window, accepted=False)
+            held = self.overtaken.release(key)
+            if held is not None:
+                conn.handle_packet(held)
+            conn._set_connected()
+        elif not flags & (SYN | ACK) and key not in self.time_wait:
+            self.overtaken.hold(key, data)
+
+    def _establish(self, key, window, accepted):
+        addr, conn_id = key
+        conn = AsyncConnection(self, addr, conn_id, mss=self.mss)
+        conn.peer_window = window
+        conn.syn_ack = self.keys.syn_ack(addr, conn_id, RECV_WINDOW, accepted)
+        self.connections[key] = conn
+        self.time_wait.discard(key)
+        self._schedule(key, KEEPALIVE_IDLE, self._check)
+        return conn
+
+    def _schedule(self, key, delay, callback):
+        self.wheel.schedule(key, delay, callback)
+        if self.ticker is None:
+            self.ticker = self.loop.call_later(TICK, self._tick)
+
+    def _tick(self):
+        self.wheel.advance(time.monotonic())
+        self.ticker = self.loop.call_later(TICK, self._tick) if self.wheel else None
+
+    def _check(self, key):
+        # Same housekeeping as UDPListener._check
+        conn = self.connections.get(key)
+        if conn is None:
+            return
+        metrics = conn.metrics
+        action, delay = conn.lifecycle.check(time.monotonic(), metrics.segments_sent + metrics.segments_received,
+                                             conn.in_flight())
+        if action == PROBE:
+            conn.keepalive()
+        elif action == IDLE:
+            self.idle_timeouts += 1
+            conn.reader.feed_eof()
+        elif action in (DEAD, ABORT):
+            self.keepalive_timeouts += action == DEAD
+            conn.abort(conn.lifecycle.error)
+        if conn.lifecycle.is_open():
+            self._schedule(key, delay, self._check)
+        elif not conn.closed:
+            conn._shutdown()
+
+    def half_closed(self, conn):
+        # Server connections are checked already; a client one needs a timer for its FIN_WAIT_2 deadline
+        if self.client_connected_cb is None and conn.lifecycle.is_open():
+            self._schedule((conn.addr, conn.conn_id), FIN_WAIT_TIMEOUT, self._check)
+
+    def _time_wait_over(self, key):
+        self.time_wait.discard(key)
+        if self.client_connected_cb is None:
+            self.transport.close()
+
+    def connection_established(self, conn):
+        if self.client_connected_cb is not None:
+            self.accepted += 1
+            result = self.client_connected_cb(conn.reader, conn.writer)
+            if asyncio.iscoroutine(result):
+                self.loop.create_task(result)
+
+    def connection_closed(self, conn):
+        key = (conn.addr, conn.conn_id)
+        self.connections.pop(key, None)
+        self.closed_metrics.merge(conn.metrics)
+        if conn.lifecycle.state == TIME_WAIT:
+            # A client endpoint keeps its transport until TIME_WAIT is over
+            self.time_wait.add(key)
+            self._schedule(key, TIME_WAIT_PERIOD, self._time_wait_over)
+            return
+        self.wheel.cancel(key)
+        if self.client_connected_cb is None:
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.ticker is not None:
+            self.ticker.cancel()
+            self.ticker = None
+
+    def stats(self):
+        # Everything runs on the loop, so no locking is needed to read the counters
+        live = list(self.connections.values())
+        stats = aggregate([self.closed_metrics] + [conn.metrics for conn in live]).snapshot()
+        stats.update(connections_active=len(live), connections_accepted=self.accepted,
+                     connections_time_wait=len(self.time_wait), syn_cookies_sent=self.syn_cookies_sent,
+                     zero_rtt_accepted=self.zero_rtt_accepted, invalid_cookies=self.invalid_cookies,
+                     keepalive_timeouts=self.keepalive_timeouts, idle_timeouts=self.idle_timeouts)
+        return stats
+
+    def error_received(self, exc):
+        pass
+
+async def start_server(client_connected_cb, host='localhost', port=8080, loss_prob=0.0, corrupt_prob=0.0,
+                       seed=None, mss=None, sock=None):
+    # sock is an already bound socket to serve on instead of (host, port), e.g. from prefork
+    loop = asyncio.get_running_loop()
+    address = {"sock": sock} if sock is not None else {"local_addr": (host, port)}
+    _, protocol = await loop.create_datagram_endpoint(
+        lambda: ReliableDatagramProtocol(loop, client_connected_cb, loss_prob=loss_prob, corrupt_prob=corrupt_prob,
+                                         seed=seed, mss=mss),
+        **address)
+    return protocol
+
+async def open_connection(host='localhost', port=8080, loss_prob=0.0, corrupt_prob=0.0, seed=None, mss=None,
+                          early_data=b""):
+    # early_data is written as soon as the connection is up; on a resumed session it rides in the SYN
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: ReliableDatagramProtocol(loop, loss_prob=loss_prob, corrupt_prob=corrupt_prob, seed=seed, mss=mss),
+        remote_addr=(host, port))
+    addr = transport.get_extra_info("peername")
+    conn = AsyncConnection(protocol, addr, random.getrandbits(32), mss=mss)
+    protocol.connections[(addr, conn.conn_id)] = conn
+    early = early_data if len(early_data) <= conn.mss - TICKET_SIZE else b""
+    try:
+        accepted = await conn.connect(early)
+    except asyncio.CancelledError:
+        # Given up on by the caller, e.g. through asyncio.wait_for; the endpoint goes with the connection
+        conn.abort(ConnectionAbortedError("connect was cancelled"))
+        raise
+    if not accepted and early_data:
+        conn.write(early_data)
+    return conn.reader, conn.writer
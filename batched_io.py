@@ -0,0 +1,235 @@
+import ctypes
+import ctypes.util
+import errno
+import select
+import collections
+import socket
+import sys
+import threading
+
+# Linux batched datagram I/O (sendmmsg/recvmmsg via ctypes) with a portable per-packet fallback
+SOCKET_BUFFER = 4 * 1024 * 1024  # requested SO_RCVBUF/SO_SNDBUF; the kernel caps it at rmem_max/wmem_max
+SEND_BATCH = 64
+RECV_BATCH = 32
+SLAB_CELLS = 32  # datagrams per receive slab
+POOL_SLABS = 64  # slabs a receiver keeps for reuse; past that, a slab still referenced is left to the GC
+MSG_DONTWAIT = 0x40
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_char_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort), ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_ubyte * 4), ("sin_zero", ctypes.c_ubyte * 8)]
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    # No argtypes: every argument is an int or a prebuilt byref(), which skips ctypes' per-call conversion
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        libc.sendmmsg, libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_libc()
+_local = threading.local()
+_addr_cache = {}
+
+def batching_available():
+    return _libc is not None
+
+def tune_buffers(sock, size=SOCKET_BUFFER):
+    # A window's worth of segments can land at once; the default ~200 KB buffer drops the tail of a burst
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+        except OSError:
+            pass
+
+def _resolve(addr):
+    # Engines may hold a hostname such as ('localhost', 8080); sendto would resolve it on every packet.
+    # Peer addresses are already IP literals and pass straight through, so only configured names are cached.
+    try:
+        socket.inet_aton(addr[0])
+        return addr
+    except (OSError, TypeError):
+        pass
+    resolved = _addr_cache.get(addr)
+    if resolved is None:
+        try:
+            resolved = socket.getaddrinfo(addr[0], addr[1], socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+        except (socket.gaierror, IndexError):
+            resolved = addr
+        _addr_cache[addr] = resolved
+    return resolved
+
+class _SendVectors:
+    # Per-thread mmsghdr array; the destination is rewritten only when it changes
+    def __init__(self):
+        self.iovecs = (iovec * SEND_BATCH)()
+        self.msgs = (mmsghdr * SEND_BATCH)()
+        self.msgs_ref = ctypes.byref(self.msgs)
+        self.name = sockaddr_in()
+        self.addr = None
+        for i in range(SEND_BATCH):
+            self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+            self.msgs[i].msg_hdr.msg_name = ctypes.addressof(self.name)
+            self.msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(self.name)
+
+    def point_at(self, addr):
+        if addr != self.addr:
+            host, port = addr
+            self.name.sin_family = socket.AF_INET
+            self.name.sin_port = socket.htons(port)
+            self.name.sin_addr[:] = socket.inet_aton(host)
+            self.addr = addr
+
+def _send_vectors():
+    vectors = getattr(_local, "vectors", None)
+    if vectors is None:
+        vectors = _local.vectors = _SendVectors()
+    return vectors
+
+def send_batch(sock, packets, addr):
+    addr = _resolve(addr)
+    # Wrappers such as net_emulator.ImpairedSocket must see every datagram, so only a plain socket is batched
+    if _libc is None or type(sock) is not socket.socket or sock.family != socket.AF_INET or len(packets) < 2:
+        for packet in packets:
+            sock.sendto(packet, addr)
+        return
+    vectors = _send_vectors()
+    vectors.point_at(addr)
+    iovecs = vectors.iovecs
+    for start in range(0, len(packets), SEND_BATCH):
+        chunk = packets[start:start + SEND_BATCH]
+        for i, packet in enumerate(chunk):
+            iovecs[i].iov_base = packet
+            iovecs[i].iov_len = len(packet)
+        sent = _libc.sendmmsg(sock.fileno(), vectors.msgs_ref, len(chunk), 0)
+        # A full send buffer (the socket is non-blocking once it has a timeout) or an error: let sendto wait or raise
+        for packet in chunk[max(sent, 0):]:
+            sock.sendto(packet, addr)
+
+class Slab:
+    # One bytearray carved into fixed-size datagram cells, filled front to back. Received packets are
+    # memoryviews into it, so it is only reused once every one of them has been dropped.
+    def __init__(self, size, cells, vectors):
+        self.size = size
+        self.cells = cells
+        self.data = bytearray(size * cells)
+        self.next = 0
+        if vectors:
+            # Per-slab mmsghdr array pointing recvmmsg at the cells; refs[i] starts a read at cell i
+            self.names = bytearray(ctypes.sizeof(sockaddr_in) * cells)
+            # Kept on the slab: each holds a fixed export of the bytearray for the slab's lifetime
+            self.buffers = buffers = (ctypes.c_char * len(self.data)).from_buffer(self.data)
+            self.sockaddrs = names = (sockaddr_in * cells).from_buffer(self.names)
+            self.iovecs = (iovec * cells)()
+            self.msgs = (mmsghdr * cells)()
+            self.refs = [ctypes.byref(self.msgs, i * ctypes.sizeof(mmsghdr)) for i in range(cells)]
+            for i in range(cells):
+                self.iovecs[i].iov_base = ctypes.cast(ctypes.addressof(buffers) + i * size, ctypes.c_char_p)
+                self.iovecs[i].iov_len = size
+                self.msgs[i].msg_hdr.msg_name = ctypes.addressof(names[i])
+                self.msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+                self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+                self.msgs[i].msg_hdr.msg_iovlen = 1
+        # Every live memoryview onto data holds one reference to it; at this count none is left
+        self.idle_refs = sys.getrefcount(self.data)
+
+    def idle(self):
+        return sys.getrefcount(self.data) == self.idle_refs
+
+class SlabPool:
+    # Full slabs wait here, oldest first, until the packets read into them are released
+    def __init__(self, size, cells=SLAB_CELLS, vectors=False, limit=POOL_SLABS):
+        self.size = size
+        self.cells = cells
+        self.vectors = vectors
+        self.full = collections.deque(maxlen=limit)
+
+    def take(self):
+        for slab in self.full:
+            if slab.idle():
+                self.full.remove(slab)
+                slab.next = 0
+                return slab
+        return Slab(self.size, self.cells, self.vectors)
+
+    def retire(self, slab):
+        self.full.append(slab)
+
+class BatchReceiver:
+    # recvfrom() that returns every datagram already queued. Datagrams land in pooled slabs and come back
+    # as memoryviews into them, so nothing is copied between the kernel and the packet parser.
+    def __init__(self, sock, size=65535, batch=RECV_BATCH):
+        self.sock = sock
+        self.size = size
+        self.batch = batch
+        self.vectors = _libc is not None and sock.family == socket.AF_INET
+        self.pool = SlabPool(size, max(SLAB_CELLS, batch), self.vectors)
+        self.slab = self.pool.take()
+        if not self.vectors:
+            return
+        self.poller = select.poll()
+        self.poller.register(sock.fileno(), select.POLLIN)
+
+    def _cells(self):
+        if self.slab.next == self.slab.cells:
+            self.pool.retire(self.slab)
+            self.slab = self.pool.take()
+        return self.slab
+
+    def recv(self):
+        # Blocks like recvfrom, honouring the socket timeout, but a burst costs one syscall instead of one each
+        slab = self._cells()
+        offset = slab.next * self.size
+        if not self.vectors:
+            length, addr = self.sock.recvfrom_into(memoryview(slab.data)[offset:offset + self.size])
+            slab.next += 1
+            return [(memoryview(slab.data)[offset:offset + length], addr)]
+        # poll then read, the same two syscalls socket.recvfrom makes with a timeout set
+        timeout = self.sock.gettimeout()
+        count = 0
+        while not count:
+            if not self.poller.poll(None if timeout is None else timeout * 1000):
+                raise socket.timeout("timed out")
+            count = self._recvmmsg(slab)
+        view = memoryview(slab.data)
+        packets = []
+        for i in range(slab.next, slab.next + count):
+            offset = i * self.size
+            packets.append((view[offset:offset + slab.msgs[i].msg_len], self._addr(slab, i)))
+        slab.next += count
+        return packets
+
+    def _recvmmsg(self, slab):
+        # Datagram count, 0 if nothing is queued; a closed socket raises OSError like recvfrom does
+        fd = self.sock.fileno()
+        if fd < 0:
+            raise OSError(errno.EBADF, "socket is closed")
+        count = _libc.recvmmsg(fd, slab.refs[slab.next], min(self.batch, slab.cells - slab.next), MSG_DONTWAIT, None)
+        if count >= 0:
+            return count
+        err = ctypes.get_errno()
+        if err in (errno.EAGAIN, errno.EINTR):
+            return 0
+        raise OSError(err, "recvmmsg failed")
+
+    def _addr(self, slab, i):
+        # sockaddr_in: family, port, address. Decoded every time; a cache would keep every peer ever seen.
+        offset = i * ctypes.sizeof(sockaddr_in)
+        return (socket.inet_ntoa(slab.names[offset + 4:offset + 8]),
+                int.from_bytes(slab.names[offset + 2:offset + 4], "big"))
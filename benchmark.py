@@ -0,0 +1,189 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import threading
+import time
+
+from reliable_udp_http import ReliableUDP
+from reliable_udp_sliding_window import ReliableUDP_GBN
+from reliable_udp_selective_repeat import ReliableUDP_SR
+from reliable_stream import ReliableStream
+from load_test import percentile
+
+# name -> engine class; windowed engines take window=, stop-and-wait is always a window of 1
+ENGINES = {"sw": ReliableUDP, "gbn": ReliableUDP_GBN, "sr": ReliableUDP_SR}
+WINDOWED = {"gbn", "sr"}
+
+# metric -> +1 if higher is better, -1 if lower is better
+METRICS = {"goodput_kbps": 1, "p50_ms": -1, "p99_ms": -1, "retransmit_ratio": -1, "cpu_s_per_mb": -1}
+# Absolute slack on top of the relative tolerance, so sub-millisecond jitter isn't a regression
+NOISE_FLOOR = {"goodput_kbps": 0.0, "p50_ms": 1.0, "p99_ms": 5.0, "retransmit_ratio": 0.02, "cpu_s_per_mb": 0.01}
+KEY_FIELDS = ("engine", "payload", "window", "loss", "corrupt", "concurrency")
+
+def open_pair(engine, window, loss, corrupt, seed):
+    cls = ENGINES[engine]
+    kwargs = {"window": window} if engine in WINDOWED else {}
+    server = cls(('localhost', 0), loss_prob=loss, corrupt_prob=corrupt, seed=seed, **kwargs)
+    client = cls(('localhost', 0), server.sock.getsockname(), loss_prob=loss, corrupt_prob=corrupt,
+                 seed=seed + 1, **kwargs)
+    return server, client
+
+def serve(engine, server, payload):
+    if engine == "sw":
+        # Completes on the client's ACK or, if that was lost, on its first request segment
+        server.handshake(is_server=True)
+    stream = ReliableStream(server)
+    body = os.urandom(payload)
+    while True:
+        request = stream.read_http_message()
+        if not request:
+            break
+        stream.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+    if engine != "sw":
+        # The client closed its side first; our FIN finishes the connection
+        server.close()
+
+def run_connection(engine, payload, window, loss, corrupt, requests, seed, results):
+    server, client = open_pair(engine, window, loss, corrupt, seed)
+    server_thread = threading.Thread(target=serve, args=(engine, server, payload))
+    server_thread.daemon = True
+    server_thread.start()
+    if engine == "sw":
+        client.handshake(is_server=False)
+    else:
+        client.connect()
+    stream = ReliableStream(client)
+    # Random bytes, so every engine is timed on binary payloads
+    request = b"POST /bench HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n" % payload + os.urandom(payload)
+    latencies, ok = [], 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        start = time.perf_counter()
+        stream.sendall(request)
+        response = stream.read_http_message(response=True)
+        latencies.append(time.perf_counter() - start)
+        ok += response.startswith(b"HTTP/1.1 200 OK") and len(response) >= payload
+    finished = time.perf_counter()
+    client.close()
+    server_thread.join(timeout=10)
+    # The engines' own counters, so the sockets stay unwrapped and keep their batched send path
+    sent = client.metrics.segments_sent + server.metrics.segments_sent
+    unique = sent - client.metrics.retransmits - server.metrics.retransmits
+    client.sock.close()
+    server.sock.close()
+    results.append((latencies, ok, sent, unique, started, finished))
+
+def run_case(engine, payload, window, loss, corrupt, concurrency, requests, seed):
+    results = []
+    threads = [
+        threading.Thread(target=run_connection,
+                         args=(engine, payload, window, loss, corrupt, requests, seed + 2 * i, results))
+        for i in range(concurrency)
+    ]
+    cpu_start = time.process_time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cpu = time.process_time() - cpu_start
+    # Goodput covers the request phase only, not handshakes or FIN teardown
+    elapsed = max(result[5] for result in results) - min(result[4] for result in results)
+
+    latencies = [latency for result in results for latency in result[0]]
+    ok = sum(result[1] for result in results)
+    sent = sum(result[2] for result in results)
+    unique = sum(result[3] for result in results)
+    # Request and response bodies both count; headers don't
+    megabytes = 2 * payload * ok / (1024 * 1024)
+    return {
+        "engine": engine, "payload": payload, "window": window, "loss": loss, "corrupt": corrupt,
+        "concurrency": concurrency, "requests": concurrency * requests, "ok": ok,
+        "elapsed_s": round(elapsed, 4),
+        "goodput_kbps": round(2 * payload * ok / elapsed / 1024, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "retransmit_ratio": round((sent - unique) / sent, 4) if sent else 0.0,
+        "cpu_s_per_mb": round(cpu / megabytes, 4) if megabytes else None,
+    }
+
+def case_key(result):
+    return tuple(result[field] for field in KEY_FIELDS)
+
+def find_regressions(results, baseline, tolerance):
+    previous = {case_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+        if result["ok"] < result["requests"]:
+            regressions.append((result, "ok", old["ok"], result["ok"]))
+        for metric, direction in METRICS.items():
+            before, after = old.get(metric), result.get(metric)
+            if before is None or after is None:
+                continue
+            if direction > 0:
+                worse = after < before * (1 - tolerance) - NOISE_FLOOR[metric]
+            else:
+                worse = after > before * (1 + tolerance) + NOISE_FLOOR[metric]
+            if worse:
+                regressions.append((result, metric, before, after))
+    return regressions
+
+def sweep(args):
+    for engine, payload, window, loss, corrupt, concurrency in itertools.product(
+            args.engines, args.payloads, args.windows, args.loss, args.corrupt, args.concurrency):
+        if engine not in WINDOWED:
+            if window != args.windows[0]:
+                continue
+            window = 1
+        yield engine, payload, window, loss, corrupt, concurrency
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Goodput/latency matrix across reliable-UDP engines")
+    parser.add_argument("--engines", nargs="+", choices=sorted(ENGINES), default=sorted(ENGINES))
+    parser.add_argument("--payloads", nargs="+", type=int, default=[1024, 65536], help="Request and response body bytes")
+    parser.add_argument("--windows", nargs="+", type=int, default=[4, 32], help="Window sizes for GBN/SR, in segments")
+    parser.add_argument("--loss", nargs="+", type=float, default=[0.0, 0.01])
+    parser.add_argument("--corrupt", nargs="+", type=float, default=[0.0])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8], help="Parallel connections")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per connection")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the median-goodput run is reported")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the results JSON")
+    parser.add_argument("--baseline", help="Results JSON from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative regression per metric")
+    args = parser.parse_args()
+
+    results = []
+    for engine, payload, window, loss, corrupt, concurrency in sweep(args):
+        # Median-goodput run of several, so one scheduler hiccup doesn't read as a regression
+        runs = sorted((run_case(engine, payload, window, loss, corrupt, concurrency, args.requests, args.seed)
+                       for _ in range(args.repeat)), key=lambda run: run["goodput_kbps"])
+        result = runs[len(runs) // 2]
+        results.append(result)
+        print(f"[BENCH] {engine:>3} payload={payload} window={window} loss={loss} corrupt={corrupt} "
+              f"conns={concurrency}: {result['goodput_kbps']:.1f} KB/s, p50 {result['p50_ms']:.1f} ms, "
+              f"p99 {result['p99_ms']:.1f} ms, retx {result['retransmit_ratio']:.3f}", flush=True)
+
+    report = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(), "seed": args.seed,
+                 "requests": args.requests, "repeat": args.repeat, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[INFO] Wrote {len(results)} results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for result, metric, before, after in regressions:
+            print(f"[REGRESSION] {' '.join(f'{field}={result[field]}' for field in KEY_FIELDS)}: "
+                  f"{metric} {before} -> {after}")
+        if regressions:
+            raise SystemExit(1)
+        print(f"[INFO] No regressions against {args.baseline}")
@@ -0,0 +1,47 @@
+import argparse
+import threading
+import time
+
+from reliable_udp_sliding_window import ReliableUDP_GBN
+from reliable_udp_selective_repeat import ReliableUDP_SR
+
+ENGINES = {"GBN": ReliableUDP_GBN, "SR": ReliableUDP_SR}
+LOSS_PROBS = [0.0, 0.05, 0.1, 0.2, 0.3]
+
+def measure_goodput(engine_cls, loss_prob, packets, payload_size, timeout, seed=None):
+    # Loss on the data path only; ACKs travel on a clean link, as in the original comparison
+    receiver = engine_cls(('localhost', 0), loss_prob=0, corrupt_prob=0, timeout=timeout)
+    sender = engine_cls(('localhost', 0), receiver.sock.getsockname(), loss_prob=loss_prob, corrupt_prob=0,
+                        timeout=timeout, seed=seed)
+    data_list = [bytes([65 + i % 26]) * payload_size for i in range(packets)]
+    received = []
+
+    def drain():
+        for _ in range(packets):
+            received.append(receiver.recv())
+
+    drain_thread = threading.Thread(target=drain)
+    drain_thread.start()
+    start = time.time()
+    sender.send(data_list)
+    drain_thread.join()
+    elapsed = time.time() - start
+
+    sender.sock.close()
+    receiver.sock.close()
+    if received != data_list:
+        raise RuntimeError(f"{engine_cls.__name__} delivered corrupted or reordered data")
+    return packets * payload_size / elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--packets", type=int, default=200, help="Packets per transfer")
+    parser.add_argument("--size", type=int, default=1024, help="Payload bytes per packet")
+    parser.add_argument("--timeout", type=float, default=0.2, help="Initial retransmission timeout in seconds")
+    parser.add_argument("--seed", type=int, default=1, help="Loss seed, so every engine sees the same drop pattern")
+    args = parser.parse_args()
+
+    print(f"{'loss':>6} " + " ".join(f"{name + ' (KB/s)':>12}" for name in ENGINES))
+    for loss_prob in LOSS_PROBS:
+        row = [measure_goodput(cls, loss_prob, args.packets, args.size, args.timeout, args.seed) / 1024 for cls in ENGINES.values()]
+        print(f"{loss_prob:>6.2f} " + " ".join(f"{kbps:>12.1f}" for kbps in row))
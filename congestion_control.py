@@ -0,0 +1,45 @@
+INITIAL_CWND = 4
+INITIAL_SSTHRESH = 0xFFFF
+MIN_SSTHRESH = 2
+MAX_CWND = 0xFFFF
+DUP_ACK_THRESHOLD = 3
+
+class CongestionControl:
+    # Reno-style window in segments: slow start, AIMD, fast retransmit
+    def __init__(self, initial_cwnd=INITIAL_CWND, ssthresh=INITIAL_SSTHRESH, max_cwnd=MAX_CWND):
+        self.cwnd = float(initial_cwnd)
+        self.ssthresh = ssthresh
+        self.max_cwnd = max_cwnd
+        self.dup_acks = 0
+
+    def window(self):
+        return int(self.cwnd)
+
+    def on_ack(self, acked):
+        self.dup_acks = 0
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_cwnd)
+
+    def on_dup_ack(self):
+        # Returns True exactly once per loss episode, on the third duplicate
+        self.dup_acks += 1
+        if self.dup_acks != DUP_ACK_THRESHOLD:
+            return False
+        self.ssthresh = max(int(self.cwnd) // 2, MIN_SSTHRESH)
+        self.cwnd = float(self.ssthresh)
+        return True
+
+    def in_recovery(self):
+        # From the third duplicate ACK until new data is acknowledged
+        return self.dup_acks >= DUP_ACK_THRESHOLD
+
+    def on_timeout(self, in_flight):
+        self.ssthresh = max(in_flight // 2, MIN_SSTHRESH)
+        self.cwnd = 1.0
+        self.dup_acks = 0
+
+    def stats(self):
+        return {"cwnd": self.cwnd, "ssthresh": self.ssthresh}
@@ -0,0 +1,140 @@
+import collections
+import hashlib
+import hmac
+import os
+import struct
+import threading
+import time
+
+from packet_codec import make_packet
+
+# Connection setup shared by the engines and listeners.
+# SYN cookies: a server answers a SYN without keeping any state. The SYN-ACK carries a MAC over the client's
+# address, conn_id and a coarse clock; the client echoes it in its handshake ACK, and only a valid echo creates
+# the connection, so half-open connections cost the server nothing.
+# Session tickets: the SYN-ACK also carries a ticket, a MAC over the client's IP and an expiry time. A returning
+# client sends the ticket and its first segment in the SYN; if the ticket checks out the server takes the segment
+# as seq 0 right away and says so in the SYN-ACK, saving the handshake round trip. A SYN replayed later is
+# accepted again, so only idempotent requests belong in one.
+SYN = 0x01
+ACK = 0x02
+COOKIE = 0x10  # on the client's handshake ACK: the payload is the echoed cookie
+COOKIE_SIZE = 8
+COOKIE_PERIOD = 30  # seconds per clock tick; a cookie is accepted for one to two ticks
+TICKET = struct.Struct("!I16s")  # expiry (unix seconds), MAC
+TICKET_SIZE = TICKET.size
+TICKET_LIFETIME = 3600
+NO_DATA_ACK = (1 << 32) - 1  # SYN-ACK ack field when the SYN carried no accepted segment
+OVERTAKEN_SLOTS = 64
+
+# Created at import, so prefork workers forked from one supervisor accept each other's tickets
+SECRET = os.urandom(32)
+
+class HandshakeKeys:
+    def __init__(self, secret=SECRET):
+        self.secret = secret
+
+    def _mac(self, size, *fields):
+        message = "|".join(str(field) for field in fields).encode()
+        return hmac.new(self.secret, message, hashlib.sha256).digest()[:size]
+
+    def cookie(self, addr, conn_id, tick=None):
+        tick = int(time.time() // COOKIE_PERIOD) if tick is None else tick
+        return self._mac(COOKIE_SIZE, "cookie", addr[0], addr[1], conn_id, tick)
+
+    def check_cookie(self, cookie, addr, conn_id):
+        tick = int(time.time() // COOKIE_PERIOD)
+        cookie = bytes(cookie)
+        return any(hmac.compare_digest(cookie, self.cookie(addr, conn_id, t)) for t in (tick, tick - 1))
+
+    def ticket(self, addr):
+        # Bound to the client's IP only: a returning client comes from a new port
+        expiry = int(time.time()) + TICKET_LIFETIME
+        return TICKET.pack(expiry, self._mac(16, "ticket", addr[0], expiry))
+
+    def check_ticket(self, ticket, addr):
+        expiry, mac = TICKET.unpack(ticket)
+        return expiry > time.time() and hmac.compare_digest(mac, self._mac(16, "ticket", addr[0], expiry))
+
+    def syn_ack(self, addr, conn_id, window, accepted):
+        # ack = 0 acknowledges the segment carried in the SYN; NO_DATA_ACK means none was taken
+        payload = self.cookie(addr, conn_id) + self.ticket(addr)
+        return make_packet(0, 0 if accepted else NO_DATA_ACK, SYN | ACK, payload, window=window, conn_id=conn_id)
+
+class OvertakenPackets:
+    # A client's first data segment can overtake its cookie ACK. Rather than drop it and wait out the
+    # client's RTO, the server holds one per key in a small fixed table; a flood of them only churns the table.
+    def __init__(self, slots=OVERTAKEN_SLOTS):
+        self.slots = slots
+        self.packets = collections.OrderedDict()
+
+    def hold(self, key, packet):
+        if key in self.packets:
+            return
+        # Copied: the packet is a view into a receive slab that is about to be reused
+        self.packets[key] = bytes(packet)
+        if len(self.packets) > self.slots:
+            self.packets.popitem(last=False)
+
+    def release(self, key):
+        return self.packets.pop(key, None)
+
+def split_syn(payload):
+    # (ticket, early segment) from a SYN's payload, ticket None when there is none
+    if len(payload) < TICKET_SIZE:
+        return None, b""
+    return bytes(payload[:TICKET_SIZE]), payload[TICKET_SIZE:]
+
+class TicketCache:
+    # Tickets a client was given, by server address; shared by every connection in the process
+    def __init__(self):
+        self.tickets = {}
+        self.lock = threading.Lock()
+
+    def get(self, addr):
+        with self.lock:
+            ticket = self.tickets.get(addr)
+        if ticket is not None and TICKET.unpack(ticket)[0] <= time.time():
+            return None
+        return ticket
+
+    def put(self, addr, ticket):
+        with self.lock:
+            self.tickets[addr] = ticket
+
+TICKETS = TicketCache()
+
+class ClientHandshake:
+    # Client half, shared by the engines: builds the SYN and answers the SYN-ACK. The cookie ACK is kept in
+    # pending_ack and resent with every retransmission until the server is heard from, since a lost one
+    # leaves the server with no connection at all.
+    def __init__(self, remote_addr, conn_id, tickets=TICKETS):
+        self.remote_addr = remote_addr
+        self.conn_id = conn_id
+        self.tickets = tickets
+        self.resuming = False
+        self.early_accepted = False
+        self.pending_ack = None
+        self.established = False
+
+    def syn(self, window, early=b""):
+        ticket = self.tickets.get(self.remote_addr) if early else None
+        self.resuming = ticket is not None
+        payload = ticket + bytes(early) if self.resuming else b""
+        return make_packet(0, 0, SYN, payload, window=window, conn_id=self.conn_id)
+
+    def on_syn_ack(self, ack, payload, window):
+        # The handshake ACK to send; duplicate SYN-ACKs get it again, in case the first was lost
+        cookie, ticket = bytes(payload[:COOKIE_SIZE]), bytes(payload[COOKIE_SIZE:COOKIE_SIZE + TICKET_SIZE])
+        if len(ticket) == TICKET_SIZE:
+            self.tickets.put(self.remote_addr, ticket)
+        self.early_accepted = self.resuming and ack == 0
+        packet = make_packet(0, NO_DATA_ACK, ACK | COOKIE, cookie, window=window, conn_id=self.conn_id)
+        # After an accepted 0-RTT SYN the server already has the connection, so nothing is resent
+        if not self.early_accepted and not self.established:
+            self.pending_ack = packet
+        return packet
+
+    def confirmed(self):
+        self.established = True
+        self.pending_ack = None
@@ -0,0 +1,367 @@
+import http
+
+# Incremental HTTP/1.1 parsing and response writing, shared by the HTTP servers and the proxy
+MAX_HEAD_BYTES = 64 * 1024  # request/status line plus headers
+MAX_HEADERS = 100
+MAX_BODY_BYTES = 64 * 1024 * 1024
+MAX_LINE_BYTES = 8 * 1024  # chunk-size and trailer lines
+NO_BODY_STATUS = (204, 304)
+HEX_DIGITS = frozenset(b"0123456789abcdefABCDEF")
+
+class HTTPParseError(Exception):
+    # status is what a server should answer with before closing the connection
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class Message:
+    def __init__(self, version, fields):
+        self.version = version
+        # As received, for forwarding; headers is the lookup view, names lowercased, repeats joined
+        self.fields = fields
+        self.headers = {}
+        for name, value in fields:
+            name = name.decode("latin-1").lower()
+            value = value.decode("latin-1")
+            self.headers[name] = f"{self.headers[name]}, {value}" if name in self.headers else value
+        self.method = self.target = self.status = self.reason = None
+        self.chunked = False
+        self.length = 0  # body bytes when Content-Length framed; None when chunked or read until close
+        self.body = b""
+
+    def tokens(self, name):
+        return [token.strip().lower() for token in self.headers.get(name, "").split(",") if token.strip()]
+
+    @property
+    def keep_alive(self):
+        connection = self.tokens("connection")
+        if "close" in connection or (self.length is None and not self.chunked):
+            return False
+        return self.version == "HTTP/1.1" or "keep-alive" in connection
+
+class HTTPParser:
+    # feed() bytes as segments arrive, then take events from next_event():
+    #   ("head", message), ("data", bytes), ("end", message), ("closed", None) at EOF between messages,
+    #   or None when more input is needed. Pipelined messages are parsed one after another.
+    def __init__(self, response=False, max_head_bytes=MAX_HEAD_BYTES, max_body_bytes=MAX_BODY_BYTES):
+        # max_body_bytes=None for callers that stream bodies through rather than hold them
+        self.response = response
+        self.max_head_bytes = max_head_bytes
+        self.max_body_bytes = max_body_bytes
+        self.buffer = bytearray()
+        self.eof = False
+        self.state = "head"
+        self.scanned = 0
+        self.message = None
+        self.remaining = 0
+        self.body_bytes = 0
+        # Methods of requests whose responses are still to come; a response to HEAD never has a body
+        self.request_methods = []
+
+    def expect_response(self, method):
+        self.request_methods.append(method)
+
+    def feed(self, data):
+        self.buffer += data
+
+    def feed_eof(self):
+        self.eof = True
+
+    def next_event(self):
+        handler = getattr(self, "_" + self.state)
+        return handler()
+
+    def _take(self, n):
+        # Body data is handed out as bytearrays; the whole buffer is passed on without a copy when it is all body
+        if n >= len(self.buffer):
+            data, self.buffer = self.buffer, bytearray()
+        else:
+            data = self.buffer[:n]
+            del self.buffer[:n]
+        return data
+
+    def _line(self):
+        end = self.buffer.find(b"\r\n")
+        if end == -1:
+            if len(self.buffer) > MAX_LINE_BYTES:
+                raise HTTPParseError(400, "Line too long")
+            self._check_truncated()
+            return None
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end + 2]
+        return line
+
+    def _check_truncated(self):
+        if self.eof:
+            raise HTTPParseError(400, "Connection closed mid-message")
+
+    def _head(self):
+        # Empty lines before a request line are ignored (RFC 9112 section 2.2)
+        while self.buffer.startswith(b"\r\n"):
+            del self.buffer[:2]
+        end = self.buffer.find(b"\r\n\r\n", self.scanned)
+        if end == -1:
+            if len(self.buffer) > self.max_head_bytes:
+                raise HTTPParseError(431, "Request header fields too large")
+            if self.eof:
+                if not self.buffer:
+                    return ("closed", None)
+                self._check_truncated()
+            self.scanned = max(len(self.buffer) - 3, 0)
+            return None
+        if end > self.max_head_bytes:
+            raise HTTPParseError(431, "Request header fields too large")
+        head = bytes(self.buffer[:end])
+        del self.buffer[:end + 4]
+        self.scanned = 0
+        self.message = self._parse_head(head)
+        self.body_bytes = 0
+        self._frame(self.message)
+        return ("head", self.message)
+
+    def _parse_head(self, head):
+        lines = head.split(b"\r\n")
+        if len(lines) - 1 > MAX_HEADERS:
+            raise HTTPParseError(431, "Too many header fields")
+        fields = []
+        for line in lines[1:]:
+            name, colon, value = line.partition(b":")
+            # Whitespace in a name also rejects obs-fold continuation lines and "Name : value" (RFC 9112 section 5)
+            if not colon or not name or b" " in name or b"\t" in name:
+                raise HTTPParseError(400, "Malformed header field")
+            fields.append((name, value.strip(b" \t")))
+        parts = lines[0].decode("latin-1").split(" ", 2)
+        if self.response:
+            if len(parts) < 2 or not parts[0].startswith("HTTP/1.") or not parts[1].isdecimal():
+                raise HTTPParseError(502, "Malformed status line")
+            message = Message(parts[0], fields)
+            message.status = int(parts[1])
+            message.reason = parts[2] if len(parts) > 2 else ""
+            return message
+        # A missing version is read as HTTP/1.0, as the servers always have
+        if len(parts) < 2 or not parts[0].isalpha():
+            raise HTTPParseError(400, "Malformed request line")
+        version = parts[2] if len(parts) > 2 else "HTTP/1.0"
+        if not version.startswith("HTTP/1."):
+            raise HTTPParseError(505, "HTTP version not supported")
+        message = Message(version, fields)
+        message.method, message.target = parts[0], parts[1]
+        return message
+
+    def _frame(self, message):
+        # Message body length, RFC 9112 section 6.3
+        request_method = self.request_methods.pop(0) if self.response and self.request_methods else None
+        if self.response and (request_method == "HEAD" or message.status < 200 or message.status in NO_BODY_STATUS):
+            self._start_length(0)
+            return
+        error = 502 if self.response else 400
+        transfer_encoding = message.tokens("transfer-encoding")
+        if transfer_encoding:
+            # Transfer-Encoding overrides Content-Length; only chunked is understood as a framing
+            if transfer_encoding[-1] == "chunked":
+                message.chunked = True
+                message.length = None
+                self.state = "chunk_size"
+                return
+            if not self.response:
+                raise HTTPParseError(501, "Unsupported transfer coding")
+            message.length = None
+            self.state = "until_close"
+            return
+        if "content-length" in message.headers:
+            values = {value.strip() for value in message.headers["content-length"].split(",")}
+            # isdecimal, not isdigit: latin-1 also has superscript digits, which int() rejects
+            if len(values) != 1 or not next(iter(values)).isdecimal():
+                raise HTTPParseError(error, "Invalid Content-Length")
+            length = int(values.pop())
+            if self.max_body_bytes is not None and length > self.max_body_bytes:
+                raise HTTPParseError(413, "Content too large")
+            self._start_length(length)
+            return
+        if self.response:
+            message.length = None
+            self.state = "until_close"
+            return
+        self._start_length(0)
+
+    def _start_length(self, length):
+        self.message.length = length
+        self.remaining = length
+        self.state = "body"
+
+    def _count(self, data):
+        self.body_bytes += len(data)
+        if self.max_body_bytes is not None and self.body_bytes > self.max_body_bytes:
+            raise HTTPParseError(413, "Content too large")
+        return ("data", data)
+
+    def _finish(self):
+        message, self.message = self.message, None
+        self.state = "head"
+        return ("end", message)
+
+    def _body(self):
+        if not self.remaining:
+            return self._finish()
+        if not self.buffer:
+            self._check_truncated()
+            return None
+        data = self._take(self.remaining)
+        self.remaining -= len(data)
+        return ("data", data)
+
+    def _until_close(self):
+        if self.buffer:
+            return self._count(self._take(len(self.buffer)))
+        return self._finish() if self.eof else None
+
+    def _chunk_size(self):
+        line = self._line()
+        if line is None:
+            return None
+        size = line.split(b";", 1)[0].strip()
+        # Hex digits only: int() would also take a sign, a 0x prefix or underscores
+        if not size or not HEX_DIGITS.issuperset(size):
+            raise HTTPParseError(502 if self.response else 400, "Invalid chunk size")
+        self.remaining = int(size, 16)
+        self.state = "chunk_data" if self.remaining else "trailer"
+        return self.next_event()
+
+    def _chunk_data(self):
+        if not self.buffer:
+            self._check_truncated()
+            return None
+        data = self._take(self.remaining)
+        self.remaining -= len(data)
+        if not self.remaining:
+            self.state = "chunk_end"
+        return self._count(data)
+
+    def _chunk_end(self):
+        if len(self.buffer) < 2:
+            self._check_truncated()
+            return None
+        if self.buffer[:2] != b"\r\n":
+            raise HTTPParseError(400, "Missing CRLF after chunk")
+        del self.buffer[:2]
+        self.state = "chunk_size"
+        return self.next_event()
+
+    def _trailer(self):
+        # Trailer fields are read and dropped
+        while True:
+            line = self._line()
+            if line is None:
+                return None
+            if not line:
+                return self._finish()
+
+def read_message(parser, read):
+    # Next complete message with its body joined, or None if the peer closed between messages.
+    # read() returns the next bytes that arrived, b"" at EOF.
+    parts = []
+    while True:
+        event = parser.next_event()
+        if event is None:
+            data = read()
+            if data:
+                parser.feed(data)
+            else:
+                parser.feed_eof()
+            continue
+        kind, value = event
+        if kind == "closed":
+            return None
+        if kind == "data":
+            parts.append(value)
+        elif kind == "end":
+            value.body = b"".join(parts)
+            return value
+
+async def read_message_async(parser, read):
+    # read_message for an awaitable read(), such as StreamReader.read
+    parts = []
+    while True:
+        event = parser.next_event()
+        if event is None:
+            data = await read()
+            if data:
+                parser.feed(data)
+            else:
+                parser.feed_eof()
+            continue
+        kind, value = event
+        if kind == "closed":
+            return None
+        if kind == "data":
+            parts.append(value)
+        elif kind == "end":
+            value.body = b"".join(parts)
+            return value
+
+def read_raw_message(parser, read):
+    # read_message, but the message's bytes exactly as received; b"" if the peer closed between messages.
+    # Bytes past the end of the message stay in parser.buffer.
+    received = [bytes(parser.buffer)]
+    total = len(received[0])
+    while True:
+        event = parser.next_event()
+        if event is None:
+            data = read()
+            if data:
+                parser.feed(data)
+                received.append(data)
+                total += len(data)
+            else:
+                parser.feed_eof()
+            continue
+        kind, _ = event
+        if kind == "closed":
+            return b""
+        if kind == "end":
+            return b"".join(received)[:total - len(parser.buffer)]
+
+async def read_raw_message_async(parser, read):
+    # read_raw_message for an awaitable read()
+    received = [bytes(parser.buffer)]
+    total = len(received[0])
+    while True:
+        event = parser.next_event()
+        if event is None:
+            data = await read()
+            if data:
+                parser.feed(data)
+                received.append(data)
+                total += len(data)
+            else:
+                parser.feed_eof()
+            continue
+        kind, _ = event
+        if kind == "closed":
+            return b""
+        if kind == "end":
+            return b"".join(received)[:total - len(parser.buffer)]
+
+def status_line(status):
+    return f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n".encode()
+
+def render_headers(fields):
+    return "".join(f"{name}: {value}\r\n" for name, value in fields).encode("latin-1")
+
+def finish_head(head, keep_alive):
+    # Status line and headers built ahead of time, plus the per-request Connection header and blank line
+    return head + (b"Connection: keep-alive\r\n\r\n" if keep_alive else b"Connection: close\r\n\r\n")
+
+def response_head(status, fields, keep_alive):
+    return finish_head(status_line(status) + render_headers(fields), keep_alive)
+
+def error_response(error):
+    # Answer to a request the parser rejected; the connection is closed after it
+    body = f"<html><body><h1>{error.status} {error}</h1></body></html>".encode()
+    return response_head(error.status, [("Content-Type", "text/html"), ("Content-Length", len(body))], False) + body
+
+def encode_chunk(data):
+    # One chunk of a chunked body, as parts for sendall_parts or writelines; LAST_CHUNK ends the body
+    return [b"%x\r\n" % len(data), data, b"\r\n"]
+
+LAST_CHUNK = b"0\r\n\r\n"
@@ -0,0 +1,168 @@
+import time
+
+# Connection teardown shared by the engines, UDPListener and the asyncio endpoint, after TCP's state machine.
+# A FIN closes one direction only: once the peer's FIN arrives recv() reports EOF, but send() keeps working,
+# so a server can finish a response to a client that already shut down its side. The side that sent the
+# first FIN lingers in TIME_WAIT afterwards to answer a retransmitted FIN whose FIN-ACK was lost.
+ESTABLISHED = "ESTABLISHED"
+FIN_WAIT = "FIN_WAIT"  # our FIN is out and not yet acknowledged
+FIN_WAIT_2 = "FIN_WAIT_2"  # our FIN is acknowledged; the peer may still send until its own FIN
+CLOSING = "CLOSING"  # both FINs crossed, ours not yet acknowledged
+CLOSE_WAIT = "CLOSE_WAIT"  # the peer's FIN arrived; we may still send
+LAST_ACK = "LAST_ACK"  # our FIN after the peer's, not yet acknowledged
+TIME_WAIT = "TIME_WAIT"
+CLOSED = "CLOSED"
+
+MAX_RETRIES = 6  # consecutive RTO expiries without progress before a connection is given up
+MAX_FIN_RTO = 1.0  # FIN retransmissions back off no further than this, so TIME_WAIT_PERIOD covers several
+TIME_WAIT_PERIOD = 4.0  # seconds
+FIN_WAIT_TIMEOUT = 30.0  # longest wait for the peer's FIN, or for a handler to close a reaped connection
+KEEPALIVE_IDLE = 15.0  # silence before the first probe
+KEEPALIVE_INTERVAL = 5.0
+KEEPALIVE_PROBES = 3  # unanswered probes before the peer is declared dead
+IDLE_TIMEOUT = 60.0  # no data either way for this long and the server closes the connection
+TICK = 0.1
+WHEEL_SLOTS = 512
+
+# What a periodic check() asks the connection's owner to do
+PROBE = "probe"
+IDLE = "idle"
+DEAD = "dead"  # keepalive probes went unanswered
+ABORT = "abort"  # past its deadline
+
+class Lifecycle:
+    def __init__(self):
+        self.state = ESTABLISHED
+        # When FIN_WAIT_2 or TIME_WAIT ends, or when a reaped connection must be gone by
+        self.deadline = None
+        # Set for an aborted connection; send() raises it
+        self.error = None
+        # Stamped by the engine for every valid packet; read by check()
+        self.last_heard = time.monotonic()
+        self.probes = 0
+        # Data segments either way at the last check, and when that count last moved
+        self.activity = 0
+        self.active_at = self.last_heard
+
+    def is_open(self):
+        return self.state not in (TIME_WAIT, CLOSED)
+
+    def close(self):
+        # Our FIN is going out; False if it already has, or the connection is gone
+        if self.state == ESTABLISHED:
+            self.state = FIN_WAIT
+        elif self.state == CLOSE_WAIT:
+            self.state = LAST_ACK
+        else:
+            return False
+        return True
+
+    def on_fin(self):
+        # The peer's FIN; True the first time, when recv() should report EOF
+        if self.state == ESTABLISHED:
+            self.state = CLOSE_WAIT
+        elif self.state == FIN_WAIT:
+            self.state = CLOSING
+        elif self.state == FIN_WAIT_2:
+            self._time_wait()
+        else:
+            return False
+        return True
+
+    def on_fin_ack(self):
+        if self.state == FIN_WAIT:
+            self.state = FIN_WAIT_2
+            self.deadline = time.monotonic() + FIN_WAIT_TIMEOUT
+        elif self.state == CLOSING:
+            self._time_wait()
+        elif self.state == LAST_ACK:
+            self.state = CLOSED
+
+    def _time_wait(self):
+        self.state = TIME_WAIT
+        self.deadline = time.monotonic() + TIME_WAIT_PERIOD
+
+    def abort(self, error):
+        if self.state != CLOSED:
+            self.state = CLOSED
+            self.error = error
+
+    def expire(self, now):
+        # Ends TIME_WAIT, or aborts a connection past its deadline; True once the connection is closed
+        if self.deadline is not None and now >= self.deadline:
+            if self.state == TIME_WAIT:
+                self.state = CLOSED
+            else:
+                self.abort(ConnectionAbortedError(f"timed out in {self.state}"))
+        return self.state == CLOSED
+
+    def check(self, now, activity, in_flight):
+        # Housekeeping for a server connection: (action or None, seconds until the next check).
+        # The connection is aborted here for DEAD and ABORT; the owner still has to wake its users.
+        # activity counts data segments either way; in_flight is unacknowledged data of ours.
+        if not self.is_open():
+            return None, None
+        if self.expire(now):
+            return ABORT, None
+        if activity != self.activity:
+            self.activity, self.active_at = activity, now
+        idle = now - self.active_at
+        if idle >= IDLE_TIMEOUT and self.deadline is None:
+            # Its handler gets EOF and closes; the deadline covers a handler that never does
+            self.deadline = now + FIN_WAIT_TIMEOUT
+            return IDLE, KEEPALIVE_INTERVAL
+        silent = now - self.last_heard
+        if in_flight:
+            # Retransmissions probe the peer already, and MAX_RETRIES gives up on it
+            self.probes = 0
+            return None, KEEPALIVE_INTERVAL
+        if silent < KEEPALIVE_IDLE:
+            self.probes = 0
+            return None, min(KEEPALIVE_IDLE - silent, max(IDLE_TIMEOUT - idle, TICK))
+        if self.probes >= KEEPALIVE_PROBES:
+            self.abort(ConnectionAbortedError("keepalive probes went unanswered"))
+            return DEAD, None
+        self.probes += 1
+        return PROBE, KEEPALIVE_INTERVAL
+
+class TimerWheel:
+    # Hashed timing wheel: arming, re-arming and cancelling are dict operations, and a tick only looks at
+    # one slot, so each waiting connection costs one small entry whatever the number of connections.
+    # Not thread-safe; each owner drives its wheel from one thread (or one event loop).
+    def __init__(self, tick=TICK, slots=WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        # key -> slot index; one timer per key
+        self.timers = {}
+        self.current = int(time.monotonic() / tick)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, delay, callback):
+        # callback(key) after delay seconds, replacing any timer already set for key
+        self.cancel(key)
+        due = max(int((time.monotonic() + delay) / self.tick) + 1, self.current + 1)
+        index = due % len(self.slots)
+        self.slots[index][key] = (due, callback)
+        self.timers[key] = index
+
+    def cancel(self, key):
+        index = self.timers.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self, now):
+        # Fire every timer due by now. After a stall longer than one turn each slot is visited once.
+        target = int(now / self.tick)
+        if target <= self.current:
+            return
+        first = max(self.current + 1, target - len(self.slots) + 1)
+        self.current = target
+        for tick in range(first, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            due = [key for key, (when, _) in slot.items() if when <= target]
+            for key in due:
+                _, callback = slot.pop(key)
+                del self.timers[key]
+                callback(key)
@@ -0,0 +1,88 @@
+import argparse
+import functools
+import multiprocessing
+import threading
+import time
+
+from udp_http_server_gbn import HTTPServerGBN, run_worker
+from prefork import Supervisor, STATS_INTERVAL
+from udp_listener import ENGINES
+from reliable_stream import ReliableStream
+
+def run_client(server_addr, mode, requests, loss_prob, results):
+    engine = ENGINES[mode](('localhost', 0), server_addr, loss_prob=loss_prob, corrupt_prob=0)
+    stream = ReliableStream(engine)
+    for i in range(requests):
+        start = time.time()
+        request = f"GET /item/{i} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode()
+        if i == 0:
+            # The first request's latency includes the handshake, or rides in the SYN on a resumed session
+            stream.connect(request)
+        else:
+            stream.sendall(request)
+        response = stream.read_http_message(response=True)
+        results.append((response.startswith(b"HTTP/1.1 200 OK"), time.time() - start))
+    # The engine closes its own socket once the teardown finishes
+    engine.close()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def run_clients(server_addr, mode, clients, requests, loss_prob):
+    # One load-generating process: clients threads, results as (ok, latency) pairs
+    results = []
+    threads = [threading.Thread(target=run_client, args=(server_addr, mode, requests, loss_prob, results))
+               for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=100, help="Concurrent client connections")
+    parser.add_argument("--requests", type=int, default=10, help="Requests per client")
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--mode", choices=sorted(ENGINES), default="gbn")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--workers", type=int, default=1, help="Prefork server worker processes")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Client processes; with several server workers one client process is the bottleneck")
+    args = parser.parse_args()
+
+    options = dict(loss_prob=args.loss, corrupt_prob=0, mode=args.mode)
+    if args.workers > 1:
+        supervisor = Supervisor(functools.partial(run_worker, **options), ('localhost', args.port), args.workers)
+        supervisor.start()
+        server_thread = threading.Thread(target=supervisor.run)
+        server_stats = supervisor.stats
+    else:
+        server = HTTPServerGBN(port=args.port, **options)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_stats = server.stats
+    server_thread.daemon = True
+    server_thread.start()
+
+    # Clients are split as evenly as possible across the processes
+    shares = [args.clients // args.processes + (i < args.clients % args.processes) for i in range(args.processes)]
+    jobs = [(('localhost', args.port), args.mode, share, args.requests, args.loss) for share in shares if share]
+    start = time.time()
+    if len(jobs) > 1:
+        with multiprocessing.get_context("fork").Pool(len(jobs)) as pool:
+            results = [result for part in pool.starmap(run_clients, jobs) for result in part]
+    else:
+        results = run_clients(*jobs[0])
+    elapsed = time.time() - start
+
+    latencies = [latency for _, latency in results]
+    ok = sum(1 for success, _ in results if success)
+    print(f"[LOAD] {args.clients} clients x {args.requests} requests: {ok}/{args.clients * args.requests} OK in {elapsed:.2f}s")
+    print(f"[LOAD] {len(results) / elapsed:.1f} req/s, p50 {percentile(latencies, 50) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms")
+    if args.workers > 1:
+        # Worker snapshots are published once a second
+        time.sleep(STATS_INTERVAL * 1.5)
+    print(f"[LOAD] open connections left on server: {server_stats().get('connections_active', 0)}")
+    if args.workers > 1:
+        supervisor.stop()
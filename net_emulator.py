@@ -0,0 +1,236 @@
+import argparse
+import heapq
+import itertools
+import random
+import selectors
+import socket
+import threading
+import time
+
+from batched_io import tune_buffers
+
+BUFFER_SIZE = 65535
+
+class Impairments:
+    # One direction of an emulated link; every decision comes from a seeded RNG so a run can be replayed
+    def __init__(self, loss=0.0, corrupt=0.0, delay=0.0, jitter=0.0, reorder=0.0, reorder_delay=0.01,
+                 duplicate=0.0, rate=None, burst=16384, seed=None):
+        self.loss = loss
+        self.corrupt = corrupt
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.duplicate = duplicate
+        self.rate = rate  # bytes per second, None for an unshaped link
+        self.burst = burst
+        self.rng = random.Random(seed)
+        self.tokens = burst
+        self.last_refill = None
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return any((self.loss, self.corrupt, self.delay, self.jitter, self.reorder, self.duplicate, self.rate))
+
+    def plan(self, packet, now):
+        # Returns [(delay_seconds, datagram), ...]: empty when dropped, two entries when duplicated
+        with self.lock:
+            if self.rng.random() < self.loss:
+                return []
+            copies = 2 if self.rng.random() < self.duplicate else 1
+            plan = []
+            for _ in range(copies):
+                datagram = packet
+                if self.rng.random() < self.corrupt:
+                    corrupted = bytearray(packet)
+                    corrupted[self.rng.randrange(len(corrupted))] ^= 0xFF
+                    datagram = bytes(corrupted)
+                delay = self._shape(len(datagram), now) + self.delay
+                if self.jitter:
+                    delay += self.rng.uniform(-self.jitter, self.jitter)
+                if self.rng.random() < self.reorder:
+                    # Held back so packets sent after it overtake it
+                    delay += self.reorder_delay
+                plan.append((max(delay, 0.0), datagram))
+            return plan
+
+    def _shape(self, size, now):
+        # Token bucket; tokens may go negative, which queues the following packets behind this one
+        if self.rate is None:
+            return 0.0
+        if self.last_refill is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        self.tokens -= size
+        return max(0.0, -self.tokens / self.rate)
+
+class DelayLine:
+    # One thread that fires delayed sends in due order; shared by every impaired socket in the process
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, delay, fn, *args):
+        with self.cond:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), fn, args))
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, fn, args = heapq.heappop(self.heap)
+            try:
+                fn(*args)
+            except OSError:
+                pass  # socket closed while the packet was in flight
+
+_delay_line = None
+_delay_line_lock = threading.Lock()
+
+def delay_line():
+    global _delay_line
+    with _delay_line_lock:
+        if _delay_line is None:
+            _delay_line = DelayLine()
+        return _delay_line
+
+class ImpairedSocket:
+    # Drop-in for a UDP socket: sendto goes through the impairments, everything else is the real socket
+    def __init__(self, sock, impairments):
+        self.sock = sock
+        self.impairments = impairments
+
+    def sendto(self, data, addr):
+        for delay, datagram in self.impairments.plan(data, time.monotonic()):
+            if delay == 0:
+                self.sock.sendto(datagram, addr)
+            else:
+                delay_line().schedule(delay, self.sock.sendto, datagram, addr)
+        return len(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class ImpairedTransport:
+    # The asyncio counterpart of ImpairedSocket; delayed sends are loop timers instead of a thread
+    def __init__(self, transport, impairments, loop):
+        self.transport = transport
+        self.impairments = impairments
+        self.loop = loop
+
+    def sendto(self, data, addr=None):
+        for delay, datagram in self.impairments.plan(data, time.monotonic()):
+            if delay == 0:
+                self.transport.sendto(datagram, addr)
+            else:
+                self.loop.call_later(delay, self._send_later, datagram, addr)
+
+    def _send_later(self, datagram, addr):
+        if not self.transport.is_closing():
+            self.transport.sendto(datagram, addr)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+def impaired_socket(local_addr, loss_prob=0.0, corrupt_prob=0.0, seed=None):
+    # How the engines open their socket; with no impairments it is just a plain bound UDP socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tune_buffers(sock)
+    sock.bind(local_addr)
+    return impair(sock, loss_prob, corrupt_prob, seed)
+
+def impair(sock, loss_prob=0.0, corrupt_prob=0.0, seed=None):
+    # For a socket bound elsewhere, such as a prefork worker's SO_REUSEPORT socket
+    impairments = Impairments(loss=loss_prob, corrupt=corrupt_prob, seed=seed)
+    if not impairments.enabled():
+        return sock
+    return ImpairedSocket(sock, impairments)
+
+class ImpairmentRelay:
+    # UDP middlebox: clients talk to listen_addr, each gets its own upstream socket (like a NAT binding)
+    def __init__(self, listen_addr, upstream_addr, forward=None, reverse=None):
+        self.upstream_addr = upstream_addr
+        self.forward = forward or Impairments()
+        self.reverse = reverse or Impairments()
+        self.front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.front.bind(listen_addr)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.front, selectors.EVENT_READ, None)
+        self.upstream = {}
+        self.closed = False
+
+    def serve_forever(self):
+        while not self.closed:
+            for key, _ in self.selector.select(timeout=0.5):
+                try:
+                    packet, addr = key.fileobj.recvfrom(BUFFER_SIZE)
+                except OSError:
+                    continue
+                if key.data is None:
+                    self._relay(self.forward, self._upstream_for(addr), packet, self.upstream_addr)
+                else:
+                    self._relay(self.reverse, self.front, packet, key.data)
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+    def _upstream_for(self, client_addr):
+        sock = self.upstream.get(client_addr)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('0.0.0.0', 0))
+            self.selector.register(sock, selectors.EVENT_READ, client_addr)
+            self.upstream[client_addr] = sock
+        return sock
+
+    def _relay(self, impairments, sock, packet, addr):
+        for delay, datagram in impairments.plan(packet, time.monotonic()):
+            if delay == 0:
+                sock.sendto(datagram, addr)
+            else:
+                delay_line().schedule(delay, sock.sendto, datagram, addr)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def close(self):
+        self.closed = True
+
+def impairments_from_args(args, seed):
+    return Impairments(loss=args.loss, corrupt=args.corrupt, delay=args.delay / 1000, jitter=args.jitter / 1000,
+                       reorder=args.reorder, duplicate=args.duplicate,
+                       rate=args.rate * 1000 / 8 if args.rate else None, seed=seed)
+
+def add_impairment_args(parser):
+    parser.add_argument("--loss", type=float, default=0.0, help="Drop probability per packet")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="Probability of flipping one byte")
+    parser.add_argument("--delay", type=float, default=0.0, help="One-way delay in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Uniform +/- jitter in ms")
+    parser.add_argument("--reorder", type=float, default=0.0, help="Probability a packet is held back and overtaken")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="Probability a packet is sent twice")
+    parser.add_argument("--rate", type=float, default=0.0, help="Bandwidth cap in kbit/s (0 = unlimited)")
+    parser.add_argument("--seed", type=int, default=None, help="RNG seed; the reverse direction uses seed + 1")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Seeded UDP impairment relay")
+    parser.add_argument("--listen-port", type=int, default=9000)
+    parser.add_argument("--upstream-host", default="localhost")
+    parser.add_argument("--upstream-port", type=int, default=8080)
+    add_impairment_args(parser)
+    args = parser.parse_args()
+
+    reverse_seed = None if args.seed is None else args.seed + 1
+    relay = ImpairmentRelay(('localhost', args.listen_port), (args.upstream_host, args.upstream_port),
+                            forward=impairments_from_args(args, args.seed),
+                            reverse=impairments_from_args(args, reverse_seed))
+    print(f"[INFO] Relaying UDP :{args.listen_port} -> {args.upstream_host}:{args.upstream_port}")
+    relay.serve_forever()
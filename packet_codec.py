@@ -0,0 +1,44 @@
+import struct
+import zlib
+
+# checksum | conn_id | seq | ack | flags | window | length, all network byte order
+HEADER = struct.Struct("!IIIIHHH")
+FIELDS = struct.Struct("!IIIHHH")
+CONN_ID = struct.Struct("!I")
+SACK_BLOCK = struct.Struct("!II")
+HEADER_SIZE = HEADER.size
+MAX_PAYLOAD = 0xFFFF
+
+def compute_checksum(fields, payload):
+    return zlib.crc32(payload, zlib.crc32(fields))
+
+def make_packet(seq, ack, flags, payload, window=0, conn_id=0):
+    fields = FIELDS.pack(conn_id, seq, ack, flags, window, len(payload))
+    return struct.pack("!I", compute_checksum(fields, payload)) + fields + payload
+
+def pack_sack(blocks):
+    # ACK payload: (start, end) seq pairs, end exclusive, for segments held past a hole
+    return b"".join(SACK_BLOCK.pack(start, end) for start, end in blocks)
+
+def unpack_sack(payload):
+    usable = len(payload) - len(payload) % SACK_BLOCK.size
+    return [SACK_BLOCK.unpack_from(payload, i) for i in range(0, usable, SACK_BLOCK.size)]
+
+def peek_conn_id(packet):
+    # Demultiplexing key only; the checksum is verified later by parse_packet
+    if len(packet) < HEADER_SIZE:
+        return None
+    return CONN_ID.unpack_from(packet, 4)[0]
+
+def parse_packet(packet):
+    # Validated in place; the payload is a memoryview into packet, so binary data passes through uncopied
+    view = memoryview(packet)
+    if len(view) < HEADER_SIZE:
+        return None
+    checksum, _, seq, ack, flags, window, length = HEADER.unpack_from(view)
+    if length != len(view) - HEADER_SIZE:
+        return None
+    payload = view[HEADER_SIZE:]
+    if compute_checksum(view[4:HEADER_SIZE], payload) != checksum:
+        return None
+    return seq, ack, flags, window, payload
@@ -0,0 +1,175 @@
+import multiprocessing
+import multiprocessing.connection
+import signal
+import socket
+import threading
+import time
+
+from batched_io import tune_buffers
+from transport_stats import merge_snapshots
+
+# Prefork mode: N worker processes, each with its own socket in one SO_REUSEPORT group on the server port.
+# The kernel picks a socket by hashing the datagram's 4-tuple, so all of a connection's datagrams reach the
+# same worker. The supervisor owns the sockets and only forks workers, so the group never changes shape:
+# a restarted worker takes over its slot's socket, and datagrams for it wait in that socket's buffer.
+STATS_INTERVAL = 1.0  # seconds between a worker's snapshots
+MIN_UPTIME = 1.0  # a worker that dies sooner than this is restarted with exponential backoff
+RESTART_BACKOFF = 0.1
+MAX_RESTART_BACKOFF = 5.0
+# Dropped from a dead worker's last snapshot; everything else is a counter and is kept in the totals
+GAUGES = ("connections_active", "connections_time_wait", "file_cache_entries", "file_cache_bytes")
+
+def reuseport_sockets(addr, count):
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise OSError("SO_REUSEPORT is not available on this platform")
+    sockets = []
+    host, port = addr
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        tune_buffers(sock)
+        # Port 0 is resolved by the first bind; the rest join that port
+        sock.bind((host, port))
+        port = sock.getsockname()[1]
+        sockets.append(sock)
+    return sockets
+
+def cluster_stats(shared):
+    # Totals over every worker, live or dead; shared is the supervisor's Manager dict
+    snapshot = shared.copy()
+    supervisor = snapshot.pop("supervisor", {})
+    stats = merge_snapshots(snapshot.values())
+    stats.update(supervisor)
+    return stats
+
+class ClusterStats:
+    # A worker's handle on the shared stats: publishes its own snapshot, reads everyone's
+    def __init__(self, shared, index):
+        self.shared = shared
+        self.index = index
+        self.local_stats = None
+
+    def attach(self, local_stats):
+        self.local_stats = local_stats
+
+    def publish(self):
+        self.shared[self.index] = self.local_stats()
+
+    def run_publisher(self):
+        # For threaded servers; asyncio servers call publish() from the loop instead
+        def loop():
+            while True:
+                self.publish()
+                time.sleep(STATS_INTERVAL)
+        publisher = threading.Thread(target=loop)
+        publisher.daemon = True
+        publisher.start()
+
+    def stats(self):
+        # Our own numbers are fresh; the other workers' are at most STATS_INTERVAL old
+        self.publish()
+        return cluster_stats(self.shared)
+
+class Supervisor:
+    # target(sock, cluster) runs a server in a worker and should not return
+    def __init__(self, target, addr, workers):
+        self.target = target
+        self.addr = addr
+        self.context = multiprocessing.get_context("fork")
+        # The manager process is forked first so it doesn't inherit the sockets
+        self.manager = self.context.Manager()
+        self.shared = self.manager.dict()
+        self.sockets = reuseport_sockets(addr, workers)
+        self.port = self.sockets[0].getsockname()[1]
+        self.workers = [None] * workers
+        self.started = [0.0] * workers
+        self.backoff = [RESTART_BACKOFF] * workers
+        self.restart_at = [0.0] * workers
+        self.restarts = 0
+        self.stopping = False
+
+    def stats(self):
+        return cluster_stats(self.shared)
+
+    def _publish(self):
+        self.shared["supervisor"] = {"workers": sum(1 for worker in self.workers if worker is not None),
+                                     "worker_restarts": self.restarts}
+
+    def _run_worker(self, index):
+        # In the child: Ctrl+C and SIGTERM kill it outright, and only its own socket stays open
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for i, sock in enumerate(self.sockets):
+            if i != index:
+                sock.close()
+        self.target(self.sockets[index], ClusterStats(self.shared, index))
+
+    def _spawn(self, index):
+        worker = self.context.Process(target=self._run_worker, args=(index,), daemon=True)
+        worker.start()
+        self.workers[index] = worker
+        self.started[index] = time.monotonic()
+        self._publish()
+
+    def _reap(self, index):
+        worker = self.workers[index]
+        worker.join()
+        self.workers[index] = None
+        now = time.monotonic()
+        if now - self.started[index] < MIN_UPTIME:
+            self.backoff[index] = min(self.backoff[index] * 2, MAX_RESTART_BACKOFF)
+        else:
+            self.backoff[index] = RESTART_BACKOFF
+        self.restart_at[index] = now + self.backoff[index]
+        # The dead worker's counters stay in the totals, folded into one retired snapshot
+        last = self.shared.pop(index, None)
+        if last is not None:
+            last = {name: value for name, value in last.items() if name not in GAUGES}
+            self.shared["retired"] = merge_snapshots([self.shared.get("retired", {}), last])
+        self._publish()
+        print(f"[SUPERVISOR] worker {index} (pid {worker.pid}) exited with code {worker.exitcode}; "
+              f"restarting in {self.backoff[index]:.1f}s")
+
+    def start(self):
+        for index in range(len(self.workers)):
+            self._spawn(index)
+        print(f"[SUPERVISOR] {len(self.workers)} workers on UDP port {self.port}")
+
+    def run(self):
+        # Watch the workers until stop(); usable from a background thread
+        while not self.stopping:
+            live = {worker.sentinel: index for index, worker in enumerate(self.workers) if worker is not None}
+            pending = [self.restart_at[index] for index, worker in enumerate(self.workers) if worker is None]
+            timeout = max(min(pending) - time.monotonic(), 0) if pending else 0.5
+            for sentinel in multiprocessing.connection.wait(list(live), timeout=min(timeout, 0.5)):
+                if not self.stopping:
+                    self._reap(live[sentinel])
+            now = time.monotonic()
+            for index, worker in enumerate(self.workers):
+                if worker is None and not self.stopping and now >= self.restart_at[index]:
+                    self.restarts += 1
+                    self._spawn(index)
+
+    def serve_forever(self):
+        def shutdown(signum, frame):
+            self.stopping = True
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+        self.start()
+        try:
+            self.run()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            if worker is not None:
+                worker.terminate()
+        for worker in self.workers:
+            if worker is not None:
+                worker.join()
+        self.workers = [None] * len(self.workers)
+        self.manager.shutdown()
+        for sock in self.sockets:
+            sock.close()
@@ -0,0 +1,168 @@
+import collections
+import re
+import socket
+import sys
+
+from packet_codec import HEADER_SIZE
+from handshake import TICKET_SIZE
+from http_message import HTTPParser, read_raw_message
+
+DEFAULT_MTU = 1500
+IP_UDP_OVERHEAD = 28
+MAX_DATAGRAM = 4096  # BUFFER_SIZE the engines pass to recvfrom
+IP_MTU = getattr(socket, "IP_MTU", 14)  # Linux-only option, missing from the socket module
+
+def path_mtu(remote_addr):
+    # Route MTU as seen by the kernel for a connected UDP socket; DEFAULT_MTU elsewhere
+    if remote_addr is None or not sys.platform.startswith("linux"):
+        return DEFAULT_MTU
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(remote_addr)
+        return probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return DEFAULT_MTU
+    finally:
+        probe.close()
+
+def mss_for_mtu(mtu):
+    return min(mtu - IP_UDP_OVERHEAD, MAX_DATAGRAM) - HEADER_SIZE
+
+def checked_mss(mss):
+    # An explicit MSS; a larger segment would be cut short by the receiver's recvfrom buffer and stall the stream
+    if not 0 < mss <= MAX_DATAGRAM - HEADER_SIZE:
+        raise ValueError(f"mss must be between 1 and {MAX_DATAGRAM - HEADER_SIZE}, got {mss}")
+    return mss
+
+class ReliableStream:
+    # Byte stream over any engine that delivers segments in order
+    def __init__(self, engine, mss=None):
+        self.engine = engine
+        self.mss = checked_mss(mss) if mss else mss_for_mtu(path_mtu(engine.remote_addr))
+        # Segments as the engine delivered them (memoryviews into its receive slabs); joined only when read
+        self.segments = collections.deque()
+        self.buffered = 0
+        self.eof = False
+
+    def connect(self, data=b""):
+        # Handshake, then data; a resumed session sends data in the SYN when it fits in one segment
+        early = data if len(data) <= self.mss - TICKET_SIZE else b""
+        if not self.engine.connect(early):
+            self.sendall(data)
+
+    def sendall(self, data):
+        view = memoryview(data)
+        segments = [view[i:i + self.mss] for i in range(0, len(view), self.mss)]
+        if segments:
+            self.engine.send_segments(segments)
+
+    def sendall_parts(self, parts):
+        # sendall(b"".join(parts)) without the join: only a segment straddling two parts is copied,
+        # so a response head followed by a mapped file body goes out as slices of the mapping
+        segments, pending, pending_length = [], [], 0
+        for part in parts:
+            view = memoryview(part)
+            while len(view):
+                piece = view[:self.mss - pending_length]
+                view = view[len(piece):]
+                if not pending and len(piece) == self.mss:
+                    segments.append(piece)
+                    continue
+                pending.append(piece)
+                pending_length += len(piece)
+                if pending_length == self.mss:
+                    segments.append(b"".join(pending))
+                    pending, pending_length = [], 0
+        if pending:
+            segments.append(b"".join(pending))
+        if segments:
+            self.engine.send_segments(segments)
+
+    def _fill(self):
+        if self.eof:
+            return False
+        segment = self.engine.recv()
+        if not segment:
+            self.eof = True
+            return False
+        self.segments.append(memoryview(segment))
+        self.buffered += len(segment)
+        return True
+
+    def _take(self, n):
+        # The first n buffered bytes; the join is the one copy between the socket and the caller
+        parts = []
+        while n > 0 and self.segments:
+            segment = self.segments.popleft()
+            if len(segment) > n:
+                self.segments.appendleft(segment[n:])
+                segment = segment[:n]
+            parts.append(segment)
+            n -= len(segment)
+            self.buffered -= len(segment)
+        return b"".join(parts)
+
+    def _find(self, delimiter, start):
+        # Offset just past the first delimiter ending after start, or -1; segments are searched in place
+        # and only the few bytes either side of a segment boundary are copied
+        pattern = re.compile(re.escape(delimiter))
+        keep = len(delimiter) - 1
+        offset, tail = 0, b""
+        for segment in self.segments:
+            end = offset + len(segment)
+            if end > start:
+                seam = (tail + bytes(segment[:keep])).find(delimiter)
+                if seam != -1:
+                    return offset - len(tail) + seam + len(delimiter)
+                match = pattern.search(segment)
+                if match:
+                    return offset + match.end()
+            if keep:
+                tail = (tail + bytes(segment[-keep:]))[-keep:]
+            offset = end
+        return -1
+
+    def _read_through(self, delimiter):
+        # Buffers until delimiter arrives; returns how many bytes that is, or everything left at EOF
+        start = 0
+        while True:
+            index = self._find(delimiter, start)
+            if index != -1:
+                return index
+            start = self.buffered
+            if not self._fill():
+                return self.buffered
+
+    def read_some(self):
+        # The next piece of the stream as it arrived, usually a memoryview of one segment; b"" at EOF
+        if not self.segments and not self._fill():
+            return b""
+        segment = self.segments.popleft()
+        self.buffered -= len(segment)
+        return segment
+
+    def recv(self, max_bytes):
+        if not self.buffered:
+            self._fill()
+        return self._take(max_bytes)
+
+    def read_exact(self, n):
+        # Shorter than n only if the peer closed the connection
+        while self.buffered < n and self._fill():
+            pass
+        return self._take(n)
+
+    def read_until(self, delimiter):
+        return self._take(self._read_through(delimiter))
+
+    def read_http_message(self, response=False):
+        # One whole request (or response) as received, head and body; b"" if the peer closed between messages.
+        # Framed by http_message's parser, which raises HTTPParseError for a malformed message.
+        parser = HTTPParser(response=response, max_body_bytes=None)
+        message = read_raw_message(parser, self.read_some)
+        if parser.buffer:
+            # The start of a pipelined message; it stays buffered for the next read
+            leftover = memoryview(bytes(parser.buffer))
+            self.segments.appendleft(leftover)
+            self.buffered += len(leftover)
+        return message
@@ -1,266 +1,351 @@
 import socket
 import time
-import hashlib
-import random
 import argparse
 
+from packet_codec import make_packet, parse_packet
+from rtt_estimator import RTTEstimator
+from reliable_stream import ReliableStream
+from net_emulator import impaired_socket
+from batched_io import BatchReceiver
+from transport_stats import ConnectionStats, Histogram, render_prometheus
+from static_files import StaticFiles
+from handshake import HandshakeKeys, ClientHandshake, OvertakenPackets, COOKIE
+from lifecycle import MAX_RETRIES, IDLE_TIMEOUT
+from http_message import (HTTPParser, HTTPParseError, read_message, status_line, render_headers, finish_head,
+                          error_response)
+
 BUFFER_SIZE = 4096
 TIMEOUT = 2
+MAX_SEQ = 1 << 32  # full seq counter rather than one alternating bit, so late duplicates stay distinguishable
+MAX_FIN_RETRIES = 5
 
 SYN = 0x01
 ACK = 0x02
 FIN = 0x04
 
 class ReliableUDP:
-    def __init__(self, local_addr, remote_addr=None, loss_prob=0.1, corrupt_prob=0.1):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind(local_addr)
+    def __init__(self, local_addr, remote_addr=None, loss_prob=0.1, corrupt_prob=0.1, seed=None):
+        self.sock = impaired_socket(local_addr, loss_prob, corrupt_prob, seed)
+        # One datagram per read: stop-and-wait acts on each packet before deciding whether to read on
+        self.receiver = BatchReceiver(self.sock, BUFFER_SIZE, batch=1)
         self.remote_addr = remote_addr
         self.seq = 0
         self.ack = 0
-        self.loss_prob = loss_prob
-        self.corrupt_prob = corrupt_prob
+        # A data packet that arrived while we were waiting for an ACK; recv() delivers it
+        self.early_packet = None
         self.seen_seq = set()
-
-    def compute_checksum(self, data):
-        return hashlib.md5(data).hexdigest()
-
-    def make_packet(self, seq, ack, flags, payload):
-        header = f"{seq}|{ack}|{flags}|".encode()
-        checksum = self.compute_checksum(header + payload).encode()
-        return checksum + b"|" + header + payload
-
-    def parse_packet(self, packet):
-        try:
-            parts = packet.split(b"|", 4)
-            if len(parts) != 5:
-                return None
-            checksum, seq, ack, flags, payload = parts
-            header_payload = b"|".join(parts[1:])
-            if checksum.decode() != self.compute_checksum(header_payload):
-                return None
-            return int(seq), int(ack), int(flags), payload
-        except Exception as e:
-            return None
+        self.metrics = ConnectionStats()
+        self.rtt = RTTEstimator(initial_rto=TIMEOUT, histogram=self.metrics.rtt)
+        self.client_handshake = ClientHandshake(remote_addr, 0)
 
     def handshake(self, is_server=False):
+        # Stateless SYN-cookie handshake, as in handshake.py; no session resumption, since HTTPClient
+        # connects before it has a request to put in the SYN
         if not is_server:
-            syn_packet = self.make_packet(self.seq, 0, SYN, b"")
+            syn_packet = self.client_handshake.syn(0)
             self.sock.sendto(syn_packet, self.remote_addr)
+            sent_at = time.time()
+            retransmitted = False
+            retries = 0
             while True:
                 try:
-                    self.sock.settimeout(TIMEOUT)
-                    packet, _ = self.sock.recvfrom(BUFFER_SIZE)
-                    parsed = self.parse_packet(packet)
+                    self.sock.settimeout(self.rtt.rto)
+                    packet, _ = self._recvfrom()
+                    parsed = parse_packet(packet)
                     if parsed is None:
                         continue
-                    seq, ack, flags, _ = parsed
+                    seq, ack, flags, _, payload = parsed
                     if flags & SYN and flags & ACK:
-                        ack_packet = self.make_packet(self.seq, seq, ACK, b"")
-                        self.sock.sendto(ack_packet, self.remote_addr)
-                        print("[CLIENT] Handshake complete.")
+                        if not retransmitted:
+                            self.rtt.sample(time.time() - sent_at)
+                        else:
+                            self.rtt.on_new_ack()
+                        self.sock.sendto(self.client_handshake.on_syn_ack(ack, payload, 0), self.remote_addr)
                         break
                 except socket.timeout:
+                    retries += 1
+                    if retries > MAX_RETRIES:
+                        raise TimeoutError(f"no SYN-ACK after {MAX_RETRIES} retransmissions")
+                    self.rtt.on_timeout()
                     self.sock.sendto(syn_packet, self.remote_addr)
+                    retransmitted = True
         else:
+            # Every SYN is answered on the spot and nothing is kept, so a client whose ACK is lost (or who
+            # never sends one) doesn't hold up the next; the session starts with the first valid cookie
+            keys = HandshakeKeys()
+            overtaken = OvertakenPackets()
+            # (addr, sent_at, retransmitted) of the last SYN-ACK, for an RTT sample; not needed for correctness
+            last_syn_ack = None
+            self.sock.settimeout(None)
             while True:
-                try:
-                    packet, addr = self.sock.recvfrom(BUFFER_SIZE)
-                    parsed = self.parse_packet(packet)
-                    if parsed is None:
-                        continue
-                    seq, ack, flags, _ = parsed
-                    if flags & SYN:
-                        self.remote_addr = addr
-                        syn_ack = self.make_packet(0, seq, SYN | ACK, b"")
-                        self.sock.sendto(syn_ack, addr)
-                        packet, _ = self.sock.recvfrom(BUFFER_SIZE)
-                        parsed = self.parse_packet(packet)
-                        if parsed is None:
-                            continue
-                        _, ack, flags, _ = parsed
-                        if flags & ACK:
-                            print("[SERVER] Handshake complete.")
-                            break
-                except socket.timeout:
+                packet, addr = self._recvfrom()
+                parsed = parse_packet(packet)
+                if parsed is None:
                     continue
+                seq, ack, flags, _, payload = parsed
+                if flags & SYN and not flags & ACK:
+                    self.sock.sendto(keys.syn_ack(addr, 0, 0, False), addr)
+                    last_syn_ack = (addr, time.time(), last_syn_ack is not None and last_syn_ack[0] == addr)
+                elif flags & COOKIE and keys.check_cookie(payload, addr, 0):
+                    self.remote_addr = addr
+                    if last_syn_ack is not None and last_syn_ack[0] == addr and not last_syn_ack[2]:
+                        self.rtt.sample(time.time() - last_syn_ack[1])
+                    held = overtaken.release(addr)
+                    if held is not None:
+                        self.early_packet = (held, addr)
+                    break
+                elif not flags & (SYN | ACK | FIN):
+                    overtaken.hold(addr, packet)
+
+    def _recvfrom(self):
+        # The packet is a memoryview into the receiver's slab, not a copy
+        return self.receiver.recv()[0]
 
     def close(self):
-        fin_packet = self.make_packet(self.seq, 0, FIN, b"")
+        fin_packet = make_packet(self.seq, 0, FIN, b"")
         self.sock.sendto(fin_packet, self.remote_addr)
+        retries = 0
         while True:
             try:
-                self.sock.settimeout(TIMEOUT)
-                packet, _ = self.sock.recvfrom(BUFFER_SIZE)
-                parsed = self.parse_packet(packet)
+                self.sock.settimeout(self.rtt.rto)
+                packet, _ = self._recvfrom()
+                parsed = parse_packet(packet)
                 if parsed is None:
                     continue
-                _, ack, flags, _ = parsed
-                if flags & ACK:
-                    print("[INFO] Connection closed.")
+                seq, ack, flags, _, _ = parsed
+                if not flags & (SYN | ACK | FIN):
+                    # The peer is still retransmitting its last segment because our ACK was lost
+                    self.sock.sendto(make_packet(0, seq, ACK, b""), self.remote_addr)
+                    self.metrics.acks_sent += 1
+                    continue
+                if flags & FIN and flags & ACK:
+                    # Only the FIN-ACK itself: a late ACK for our last data segment doesn't mean the FIN arrived
                     break
             except socket.timeout:
+                # The peer may already be gone and its FIN-ACK lost; don't wait forever
+                retries += 1
+                if retries >= MAX_FIN_RETRIES:
+                    break
+                self.rtt.on_timeout()
                 self.sock.sendto(fin_packet, self.remote_addr)
 
     def send(self, data):
-        packet = self.make_packet(self.seq, 0, 0, data)
+        packet = make_packet(self.seq, 0, 0, data)
+        sent_at = None
+        for _ in range(MAX_RETRIES + 1):
+            if sent_at is not None and self.client_handshake.pending_ack is not None:
+                # No ACK since the handshake: the server may never have got our cookie
+                self.sock.sendto(self.client_handshake.pending_ack, self.remote_addr)
+            self.sock.sendto(packet, self.remote_addr)
+            # Karn's algorithm: once the packet has gone out twice its ACK is ambiguous
+            retransmitted = sent_at is not None
+            self.metrics.segments_sent += 1
+            self.metrics.retransmits += retransmitted
+            self.metrics.window.observe(1)
+            sent_at = time.time()
+            if self._wait_for_ack(sent_at + self.rtt.rto):
+                if not retransmitted:
+                    self.rtt.sample(time.time() - sent_at)
+                else:
+                    self.rtt.on_new_ack()
+                self.seq = (self.seq + 1) % MAX_SEQ
+                return
+            self.metrics.timeouts += 1
+            self.rtt.on_timeout()
+        raise ConnectionAbortedError(f"no ACK after {MAX_RETRIES} retransmissions")
+
+    def _wait_for_ack(self, deadline):
+        # Unrelated packets don't trigger a resend; only the RTO expiring does
         while True:
-            if random.random() > self.loss_prob:
-                self.sock.sendto(packet, self.remote_addr)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
             try:
-                self.sock.settimeout(TIMEOUT)
-                response, _ = self.sock.recvfrom(BUFFER_SIZE)
-                parsed = self.parse_packet(response)
-                if parsed is None:
-                    continue
-                r_seq, r_ack, r_flags, _ = parsed
-                if r_flags & ACK and r_ack == self.seq:
-                    self.seq = 1 - self.seq
-                    return
+                self.sock.settimeout(remaining)
+                response, addr = self._recvfrom()
             except socket.timeout:
+                return False
+            parsed = parse_packet(response)
+            if parsed is None:
+                self.metrics.checksum_failures += 1
                 continue
+            r_seq, r_ack, r_flags, _, _ = parsed
+            if not r_flags & SYN:
+                self.client_handshake.confirmed()
+            if not r_flags & (SYN | ACK | FIN):
+                if r_seq != self.ack:
+                    # The peer is still retransmitting an old segment because our ACK was lost
+                    self.sock.sendto(make_packet(0, r_seq, ACK, b""), self.remote_addr)
+                    self.metrics.acks_sent += 1
+                elif self.early_packet is None:
+                    # The peer's next segment overtook our ACK; recv() delivers it
+                    self.early_packet = (response, addr)
+                continue
+            if r_flags & ACK and not r_flags & SYN:
+                if r_ack == self.seq:
+                    return True
+                self.metrics.duplicate_acks += 1
+
+    def stats(self):
+        stats = {"rto": self.rtt.rto}
+        stats.update(self.metrics.snapshot())
+        return stats
+
+    def send_segments(self, segments):
+        for segment in segments:
+            self.send(segment)
 
     def recv(self):
+        # A peer silent for IDLE_TIMEOUT is taken to be gone, and reads as EOF
+        idle_until = time.monotonic() + IDLE_TIMEOUT
         while True:
             try:
-                self.sock.settimeout(TIMEOUT)
-                packet, addr = self.sock.recvfrom(BUFFER_SIZE)
-
-                if random.random() < self.corrupt_prob:
-                    corrupted = bytearray(packet)
-                    index = random.randint(0, len(corrupted) - 1)
-                    corrupted[index] ^= 0xFF
-                    packet = bytes(corrupted)
+                if self.early_packet is not None:
+                    packet, addr = self.early_packet
+                    self.early_packet = None
+                else:
+                    self.sock.settimeout(TIMEOUT)
+                    packet, addr = self._recvfrom()
 
-                parsed = self.parse_packet(packet)
+                parsed = parse_packet(packet)
                 if parsed is None:
+                    self.metrics.checksum_failures += 1
                     continue
-                seq, ack, flags, payload = parsed
+                seq, ack, flags, _, payload = parsed
+                idle_until = time.monotonic() + IDLE_TIMEOUT
 
-                try:
-                    payload.decode()
-                except UnicodeDecodeError:
+                if flags & (SYN | ACK):
+                    # Late handshake packet or a duplicate ACK for a segment we already finished sending
                     continue
 
-                
-
                 if flags & FIN:
-                    ack_packet = self.make_packet(0, seq, ACK, b"")
+                    ack_packet = make_packet(0, seq, FIN | ACK, b"")
                     self.sock.sendto(ack_packet, addr)
-                    print("[INFO] FIN received, connection closing.")
                     return b""
 
+                self.metrics.segments_received += 1
                 if seq != self.ack:
+                    # Duplicate of an earlier packet: our ACK was lost, or the network delayed or copied it
+                    self.sock.sendto(make_packet(0, seq, ACK, b""), addr)
+                    self.metrics.acks_sent += 1
                     continue
 
-                ack_packet = self.make_packet(0, seq, ACK, b"")
+                ack_packet = make_packet(0, seq, ACK, b"")
                 self.sock.sendto(ack_packet, addr)
-                self.ack = 1 - self.ack
+                self.metrics.acks_sent += 1
+                self.ack = (self.ack + 1) % MAX_SEQ
                 self.remote_addr = addr
                 return payload
             except socket.timeout:
+                if time.monotonic() >= idle_until:
+                    return b""
                 continue
 
 class HTTPServer:
-    def __init__(self, host='localhost', port=8080, loss_prob=0.1, corrupt_prob=0.1):
-        self.server = ReliableUDP((host, port), loss_prob=loss_prob, corrupt_prob=corrupt_prob)
+    def __init__(self, host='localhost', port=8080, loss_prob=0.1, corrupt_prob=0.1, mss=None, seed=None, root=None):
+        # With a document root, GET/HEAD serve files from it; without one, pages are synthesized
+        self.files = StaticFiles(root) if root else None
+        self.server = ReliableUDP((host, port), loss_prob=loss_prob, corrupt_prob=corrupt_prob, seed=seed)
         self.server.handshake(is_server=True)
+        self.stream = ReliableStream(self.server, mss=mss)
+        self.parser = HTTPParser()
+        self.requests = 0
+        self.request_latency = Histogram()
+
+    def stats(self):
+        stats = self.server.stats()
+        stats.update(requests=self.requests, request_latency_seconds=self.request_latency.snapshot())
+        if self.files is not None:
+            stats.update(self.files.stats())
+        return stats
 
     def serve_forever(self):
         print("HTTP Server started.")
         while True:
             try:
-                data = self.server.recv()
-                if data == b"":
-                    break
                 try:
-                    request = data.decode()
-                except UnicodeDecodeError:
-                    print("Received undecodable packet, likely corrupted.")
-                    continue
-
-                lines = request.split('\r\n')
-                if not lines:
-                    continue
-                try:
-                    method_line = lines[0].split()
-                    method = method_line[0]
-                    path = method_line[1] if len(method_line) > 1 else "/"
-                except Exception as e:
-                    print("Failed to parse method line:", e)
-                    continue
-
-                headers = {}
-                for line in lines[1:]:
-                    if line == "":
-                        break
-                    parts = line.split(":", 1)
-                    if len(parts) == 2:
-                        headers[parts[0].strip()] = parts[1].strip()
+                    request = read_message(self.parser, self.stream.read_some)
+                except HTTPParseError as e:
+                    # The stream can't be resynchronised after a malformed request: answer and end the session
+                    self.stream.sendall(error_response(e))
+                    break
+                if request is None:
+                    break
+                started = time.perf_counter()
+                method, path, headers = request.method, request.target, request.headers
 
-                if method == 'GET':
+                head = None
+                content_type = "text/html"
+                if method == 'GET' and path == "/metrics":
+                    content = render_prometheus(self.stats())
+                    content_type = "text/plain; version=0.0.4"
+                    status = 200
+                elif self.files is not None and method in ('GET', 'HEAD'):
+                    head, response_body = self.files.respond(method, path, headers)
+                elif method == 'GET':
                     content = f"<html><body><h1>You requested {path}</h1></body></html>"
-                    status = "HTTP/1.0 200 OK"
+                    status = 200
                 elif method == 'POST':
-                    body_index = request.find("\r\n\r\n")
-                    body = request[body_index + 4:] if body_index != -1 else ""
-                    print(f"[POST BODY] {body}")
-                    content = f"<html><body><h1>POST Received: {body}</h1></body></html>"
-                    status = "HTTP/1.0 200 OK"
+                    text = request.body.decode(errors="replace")
+                    content = f"<html><body><h1>POST Received: {text}</h1></body></html>"
+                    status = 200
                 else:
                     content = "<html><body><h1>404 Not Found</h1></body></html>"
-                    status = "HTTP/1.0 404 Not Found"
+                    status = 404
 
-                response = (
-                    f"{status}\r\n"
-                    f"Content-Length: {len(content)}\r\n"
-                    f"Content-Type: text/html\r\n"
-                    f"Server: ReliableUDPServer/1.0\r\n\r\n"
-                    f"{content}"
-                )
-                self.server.send(response.encode())
+                if head is None:
+                    response_body = content.encode()
+                    head = status_line(status) + render_headers([("Content-Length", len(response_body)),
+                                                                 ("Content-Type", content_type)])
+                # The session outlives the request either way; the client decides when to FIN
+                head += render_headers([("Server", "ReliableUDPServer/1.0")])
+                self.stream.sendall_parts([finish_head(head, request.keep_alive), response_body])
+                self.requests += 1
+                self.request_latency.observe(time.perf_counter() - started)
             except Exception as e:
                 print("Server error:", e)
                 continue
 
 class HTTPClient:
-    def __init__(self, server_addr, loss_prob=0.1, corrupt_prob=0.1):
-        self.client = ReliableUDP(('0.0.0.0', 0), server_addr, loss_prob=loss_prob, corrupt_prob=corrupt_prob)
+    def __init__(self, server_addr, loss_prob=0.1, corrupt_prob=0.1, mss=None, seed=None):
+        self.client = ReliableUDP(('0.0.0.0', 0), server_addr, loss_prob=loss_prob, corrupt_prob=corrupt_prob, seed=seed)
         self.client.handshake(is_server=False)
+        self.stream = ReliableStream(self.client, mss=mss)
 
     def get(self, path):
         request = (
-            f"GET {path} HTTP/1.0\r\n"
+            f"GET {path} HTTP/1.1\r\n"
             f"Host: localhost\r\n"
             f"User-Agent: ReliableUDPClient/1.0\r\n"
-            f"Connection: close\r\n\r\n"
+            f"Connection: keep-alive\r\n\r\n"
         )
-        self.client.send(request.encode())
+        self.stream.sendall(request.encode())
         for _ in range(5):
             try:
-                response = self.client.recv()
-                print("Received:\n", response.decode())
-                break
+                response = self.stream.read_http_message(response=True)
+                print("Received:\n", response.decode(errors="replace"))
+                return response
             except Exception as e:
                 print("GET timeout or error, retrying...", e)
                 time.sleep(1)
 
-    def post(self, path, body=""):
-        request = (
-            f"POST {path} HTTP/1.0\r\n"
+    def post(self, path, body="", content_type="text/plain"):
+        # body may be str or bytes; bytes go out untouched
+        body = body.encode() if isinstance(body, str) else body
+        head = (
+            f"POST {path} HTTP/1.1\r\n"
             f"Host: localhost\r\n"
             f"User-Agent: ReliableUDPClient/1.0\r\n"
             f"Content-Length: {len(body)}\r\n"
-            f"Content-Type: text/plain\r\n"
-            f"Connection: close\r\n\r\n"
-            f"{body}"
+            f"Content-Type: {content_type}\r\n"
+            f"Connection: keep-alive\r\n\r\n"
         )
-        self.client.send(request.encode())
+        self.stream.sendall(head.encode() + body)
         for _ in range(5):
             try:
-                response = self.client.recv()
-                print("Received:\n", response.decode())
-                break
+                response = self.stream.read_http_message(response=True)
+                print("Received:\n", response.decode(errors="replace"))
+                return response
             except Exception as e:
                 print("POST timeout or error, retrying...", e)
                 time.sleep(1)
@@ -270,13 +355,18 @@ if __name__ == '__main__':
     parser.add_argument("role", choices=["server", "client"], help="Run as server or client")
     parser.add_argument("--loss", type=float, default=0.1, help="Packet loss probability")
     parser.add_argument("--corrupt", type=float, default=0.1, help="Packet corruption probability")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the emulated loss/corruption")
+    parser.add_argument("--mss", type=int, default=None, help="Maximum segment size (default: derived from path MTU)")
+    parser.add_argument("--root", default=None, help="Document root to serve files from (server role)")
     args = parser.parse_args()
 
     if args.role == "server":
-        server = HTTPServer(loss_prob=args.loss, corrupt_prob=args.corrupt)
+        server = HTTPServer(loss_prob=args.loss, corrupt_prob=args.corrupt, mss=args.mss, seed=args.seed,
+                            root=args.root)
         server.serve_forever()
     elif args.role == "client":
-        client = HTTPClient(('localhost', 8080), loss_prob=args.loss, corrupt_prob=args.corrupt)
+        client = HTTPClient(('localhost', 8080), loss_prob=args.loss, corrupt_prob=args.corrupt, mss=args.mss,
+                            seed=args.seed)
         client.get("/index.html")
         client.post("/submit", "name=Project")
         client.client.close()
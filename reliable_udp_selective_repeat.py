@@ -0,0 +1,274 @@
+import socket
+import threading
+import queue
+import time
+import random
+
+from packet_codec import make_packet, parse_packet
+from batched_io import BatchReceiver, send_batch
+from net_emulator import impaired_socket
+from rtt_estimator import RTTEstimator
+from transport_stats import ConnectionStats
+from handshake import ClientHandshake, COOKIE, NO_DATA_ACK
+from lifecycle import Lifecycle, MAX_RETRIES, MAX_FIN_RTO, TICK
+
+BUFFER_SIZE = 4096
+TIMEOUT = 2
+WINDOW_SIZE = 4
+MAX_SEQ = 1 << 32  # width of the seq field in packet_codec.HEADER
+MAX_FIN_RETRIES = 5
+
+SYN = 0x01
+ACK = 0x02
+FIN = 0x04
+
+class ReliableUDP_SR:
+    def __init__(self, local_addr, remote_addr=None, loss_prob=0.1, corrupt_prob=0.1, timeout=TIMEOUT,
+                 sock=None, conn_id=None, seed=None, window=WINDOW_SIZE):
+        self.remote_addr = remote_addr
+        self.conn_id = random.getrandbits(32) if conn_id is None else conn_id
+        self.metrics = ConnectionStats()
+        self.rtt = RTTEstimator(initial_rto=timeout, histogram=self.metrics.rtt)
+        # Fixed send and receive window; both ends must agree on it
+        self.window = window
+        self.lock = threading.Lock()
+        # Sender side: unacked segments keyed by absolute seq, each with its own timer
+        self.base = 0
+        self.next_seq = 0
+        self.buffer = {}
+        # Receiver side: out-of-order segments held until the gap before them is filled
+        self.expected_seq = 0
+        self.recv_buffer = {}
+        self.recv_queue = queue.Queue()
+        self.ack_event = threading.Event()
+        self.connected = threading.Event()
+        self.handshake = ClientHandshake(remote_addr, self.conn_id)
+        # A standalone server end: no UDPListener, so the state exists before the handshake anyway
+        self.listening = remote_addr is None
+        # Server side: set by the UDPListener, the answer to a retransmitted SYN whose SYN-ACK was lost
+        self.syn_ack = None
+        self.fin_acked = threading.Event()
+        # Every segment is ACKed as it arrives, so no delayed ACK is ever owed (see ReliableUDP_GBN.flush_ack)
+        self.ack_due = None
+        self.lifecycle = Lifecycle()
+        self.recv_thread = None
+        if sock is not None:
+            # Shared socket owned by a UDPListener, which feeds us via handle_packet and impairs it for us
+            self.sock = sock
+            return
+        self.sock = impaired_socket(local_addr, loss_prob, corrupt_prob, seed)
+        self.recv_thread = threading.Thread(target=self._recv_loop)
+        self.recv_thread.daemon = True
+        self.recv_thread.start()
+
+    def _recv_loop(self):
+        receiver = BatchReceiver(self.sock, BUFFER_SIZE)
+        while True:
+            try:
+                # Teardown as in ReliableUDP_GBN._recv_loop
+                self.sock.settimeout(TIMEOUT if self.lifecycle.deadline is None else TICK)
+                packets = receiver.recv()
+            except socket.timeout:
+                packets = []
+            except OSError:
+                break
+            for packet, addr in packets:
+                self.handle_packet(packet, addr)
+            if self.lifecycle.expire(time.monotonic()):
+                self.sock.close()
+                break
+
+    def handle_packet(self, packet, addr):
+        parsed = parse_packet(packet)
+        if parsed is None:
+            self.metrics.checksum_failures += 1
+            return
+        seq, ack, flags, _, payload = parsed
+        self.lifecycle.last_heard = time.monotonic()
+        if flags & SYN:
+            self._handle_syn(ack, flags, payload, addr)
+            return
+        if self.listening:
+            # Standalone server side: the handshake ACK, or data if that ACK was lost
+            self.connected.set()
+        # Client side: anything past the SYN-ACK means our cookie ACK got through
+        self.handshake.confirmed()
+        if flags & COOKIE:
+            # Server side: a duplicate handshake ACK
+            return
+        if flags & FIN:
+            self._handle_fin(flags, addr)
+        elif flags & ACK:
+            self._handle_ack(ack)
+        else:
+            self._handle_data(seq, payload, addr)
+
+    def _handle_syn(self, ack, flags, payload, addr):
+        if flags & ACK:
+            # Re-ACK duplicate SYN-ACKs too, in case our first ACK was lost
+            self.sock.sendto(self.handshake.on_syn_ack(ack, payload, 0), addr)
+            self.connected.set()
+        elif self.syn_ack is not None:
+            self.sock.sendto(self.syn_ack, addr)
+        elif self.listening:
+            # A plain SYN-ACK: with no listener there is no state to spare, and the SYN's data is declined
+            self.remote_addr = addr
+            self.sock.sendto(make_packet(0, NO_DATA_ACK, SYN | ACK, b"", conn_id=self.conn_id), addr)
+
+    def accept_early_data(self, payload):
+        # Server side: segment 0 came in a resumed SYN, and the SYN-ACK acknowledges it
+        self.metrics.segments_received += 1
+        self.recv_queue.put(payload)
+        self.expected_seq = 1
+
+    def _handle_fin(self, flags, addr):
+        if flags & ACK:
+            self.lifecycle.on_fin_ack()
+            self.fin_acked.set()
+            return
+        self.sock.sendto(make_packet(0, 0, FIN | ACK, b"", conn_id=self.conn_id), addr)
+        if self.lifecycle.on_fin():
+            self.recv_queue.put(b"")
+
+    def connect(self, early=b""):
+        # early is at most one segment; True if it rode in the SYN on a resumed session and the server took it
+        syn = self.handshake.syn(0, early)
+        sent_at = time.time()
+        self.sock.sendto(syn, self.remote_addr)
+        retries = 0
+        while not self.connected.wait(self.rtt.rto):
+            retries += 1
+            if retries > MAX_RETRIES:
+                # The engine's socket and thread close with the aborted connection
+                error = TimeoutError(f"no SYN-ACK after {MAX_RETRIES} retransmissions")
+                self.abort(error)
+                raise error
+            self.rtt.on_timeout()
+            self.sock.sendto(syn, self.remote_addr)
+            sent_at = None
+        if sent_at is not None:
+            self.rtt.sample(time.time() - sent_at)
+        if self.handshake.early_accepted:
+            self.base = self.next_seq = 1
+        return self.handshake.early_accepted
+
+    def close(self):
+        # Half-close, as ReliableUDP_GBN.close; every segment is ACKed at once, so there is no ACK to flush
+        if not self.lifecycle.close():
+            return
+        fin = make_packet(0, 0, FIN, b"", conn_id=self.conn_id)
+        for _ in range(MAX_FIN_RETRIES):
+            self.sock.sendto(fin, self.remote_addr)
+            if self.fin_acked.wait(min(self.rtt.rto, MAX_FIN_RTO)):
+                return
+            self.rtt.on_timeout()
+        self.abort(ConnectionAbortedError("FIN was never acknowledged"))
+
+    def abort(self, error):
+        self.lifecycle.abort(error)
+        self.recv_queue.put(b"")
+        self.ack_event.set()
+        self.fin_acked.set()
+
+    def shutdown_read(self):
+        self.recv_queue.put(b"")
+
+    def keepalive(self):
+        # Same probe as ReliableUDP_GBN.keepalive; the peer re-ACKs a segment it already has
+        self.sock.sendto(make_packet((self.base - 1) % MAX_SEQ, 0, 0, b"", conn_id=self.conn_id), self.remote_addr)
+
+    def in_flight(self):
+        return len(self.buffer)
+
+    def _handle_ack(self, ack):
+        with self.lock:
+            offset = (ack - self.base) % MAX_SEQ
+            if offset >= self.next_seq - self.base:
+                return
+            acked = self.buffer.pop(self.base + offset, None)
+            if acked is None:
+                # Segment already ACKed: the peer answered a retransmission too
+                self.metrics.duplicate_acks += 1
+                return
+            if not acked[2]:
+                self.rtt.sample(time.time() - acked[1])
+            else:
+                self.rtt.on_new_ack()
+            while self.base < self.next_seq and self.base not in self.buffer:
+                self.base += 1
+            self.ack_event.set()
+
+    def _handle_data(self, seq, payload, addr):
+        self.remote_addr = addr
+        self.metrics.segments_received += 1
+        offset = (seq - self.expected_seq) % MAX_SEQ
+        if offset < self.window:
+            self.recv_buffer.setdefault(self.expected_seq + offset, payload)
+            while self.expected_seq in self.recv_buffer:
+                self.recv_queue.put(self.recv_buffer.pop(self.expected_seq))
+                self.expected_seq += 1
+        elif offset < MAX_SEQ - self.window:
+            return
+        # ACK every segment individually, including re-sends from the previous window
+        ack_packet = make_packet(0, seq, ACK, b"", conn_id=self.conn_id)
+        self.sock.sendto(ack_packet, addr)
+        self.metrics.acks_sent += 1
+
+    def send(self, data_list):
+        start = self.next_seq
+        end = start + len(data_list)
+        retries, stuck_at = 0, self.base
+
+        while self.base < end:
+            if self.lifecycle.error is not None:
+                raise self.lifecycle.error
+            if self.base != stuck_at:
+                retries, stuck_at = 0, self.base
+            with self.lock:
+                packets = []
+                while self.next_seq < self.base + self.window and self.next_seq < end:
+                    payload = data_list[self.next_seq - start]
+                    packet = make_packet(self.next_seq % MAX_SEQ, 0, 0, payload, conn_id=self.conn_id)
+                    self.buffer[self.next_seq] = (packet, time.time(), False)
+                    packets.append(packet)
+                    self.next_seq += 1
+                send_batch(self.sock, packets, self.remote_addr)
+                self.metrics.segments_sent += len(packets)
+                self.metrics.window.observe(self.next_seq - self.base)
+
+            with self.lock:
+                oldest = min((ts for _, ts, _ in self.buffer.values()), default=time.time())
+            self.ack_event.wait(timeout=max(0, oldest + self.rtt.rto - time.time()))
+            self.ack_event.clear()
+
+            with self.lock:
+                now = time.time()
+                expired = [seq for seq, (_, ts, _) in self.buffer.items() if now - ts >= self.rtt.rto]
+                if expired:
+                    retries += 1
+                    if retries > MAX_RETRIES:
+                        self.abort(ConnectionAbortedError(f"no ACK after {MAX_RETRIES} retransmissions"))
+                        continue
+                    if self.handshake.pending_ack is not None:
+                        # Nothing heard since the handshake: the server may never have got our cookie
+                        self.sock.sendto(self.handshake.pending_ack, self.remote_addr)
+                    self.metrics.timeouts += 1
+                    self.rtt.on_timeout()
+                self.metrics.segments_sent += len(expired)
+                self.metrics.retransmits += len(expired)
+                for seq in expired:
+                    pkt, _, _ = self.buffer[seq]
+                    self.buffer[seq] = (pkt, time.time(), True)
+                send_batch(self.sock, [self.buffer[seq][0] for seq in expired], self.remote_addr)
+
+    def stats(self):
+        with self.lock:
+            stats = {"rto": self.rtt.rto, "window": self.window, "in_flight": len(self.buffer)}
+        stats.update(self.metrics.snapshot())
+        return stats
+
+    def send_segments(self, segments):
+        self.send(segments)
+
+    def recv(self):
+        return self.recv_queue.get()
@@ -1,109 +1,406 @@
 import socket
 import threading
+import queue
 import time
-import hashlib
 import random
 
+from packet_codec import make_packet, parse_packet, pack_sack, unpack_sack
+from batched_io import BatchReceiver, send_batch
+from net_emulator import impaired_socket
+from rtt_estimator import RTTEstimator
+from transport_stats import ConnectionStats
+from congestion_control import CongestionControl, MAX_CWND
+from handshake import ClientHandshake, COOKIE, NO_DATA_ACK
+from lifecycle import Lifecycle, MAX_RETRIES, MAX_FIN_RTO, TICK
+
 BUFFER_SIZE = 4096
 TIMEOUT = 2
-WINDOW_SIZE = 4
-MAX_SEQ = 256
+WINDOW_SIZE = 4  # initial congestion window, in segments
+RECV_WINDOW = 1024  # segments the receiver will queue before recv() drains them
+MAX_SEQ = 1 << 32  # width of the seq field in packet_codec.HEADER
+MAX_FIN_RETRIES = 5
+ACK_EVERY = 2  # in-order segments per delayed ACK
+ACK_DELAY = 0.01  # seconds a lone segment waits for its ACK; well under MIN_RTO
+MAX_SACK_BLOCKS = 4
 
+SYN = 0x01
 ACK = 0x02
+FIN = 0x04
+PSH = 0x08  # last segment of a send(): the receiver ACKs it without delay
+
+def sack_blocks(held):
+    # Wire (start, end) ranges for the out-of-order segments in held, lowest first
+    blocks = []
+    for seq in sorted(held):
+        if blocks and blocks[-1][1] == seq:
+            blocks[-1][1] = seq + 1
+        elif len(blocks) < MAX_SACK_BLOCKS:
+            blocks.append([seq, seq + 1])
+        else:
+            break
+    return [(start % MAX_SEQ, end % MAX_SEQ) for start, end in blocks]
 
 class ReliableUDP_GBN:
-    def __init__(self, local_addr, remote_addr=None, loss_prob=0.1, corrupt_prob=0.1):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind(local_addr)
+    def __init__(self, local_addr, remote_addr=None, loss_prob=0.1, corrupt_prob=0.1, timeout=TIMEOUT,
+                 sock=None, conn_id=None, seed=None, window=MAX_CWND):
         self.remote_addr = remote_addr
-        self.loss_prob = loss_prob
-        self.corrupt_prob = corrupt_prob
+        self.conn_id = random.getrandbits(32) if conn_id is None else conn_id
+        self.metrics = ConnectionStats()
+        self.rtt = RTTEstimator(initial_rto=timeout, histogram=self.metrics.rtt)
+        # window caps cwnd; by default only congestion control and the peer's window limit it
+        self.cc = CongestionControl(initial_cwnd=min(WINDOW_SIZE, window), max_cwnd=window)
+        self.peer_window = RECV_WINDOW
         self.lock = threading.Lock()
+        # base/next_seq/expected_seq are absolute counters; only seq % MAX_SEQ goes on the wire
         self.base = 0
         self.next_seq = 0
+        self.high_seq = 0
         self.buffer = {}
+        # Segments above base the receiver reported holding (SACK), and holes already resent since the last timeout
+        self.sacked = set()
+        self.rexmitted = set()
+        self.expected_seq = 0
+        # Receive side: out-of-order segments within RECV_WINDOW, and in-order ones not yet ACKed
+        self.ooo = {}
+        self.unacked = 0
+        # When the delayed ACK for a lone segment is due; sent by flush_ack from the thread that feeds us packets
+        self.ack_due = None
+        self.ack_lock = threading.Lock()
+        self.recv_queue = queue.Queue()
         self.ack_event = threading.Event()
-        self.recv_thread = threading.Thread(target=self._recv_acks)
+        self.connected = threading.Event()
+        self.handshake = ClientHandshake(remote_addr, self.conn_id)
+        # A standalone server end: no UDPListener, so the state exists before the handshake anyway
+        self.listening = remote_addr is None
+        # Server side: set by the UDPListener, the answer to a retransmitted SYN whose SYN-ACK was lost
+        self.syn_ack = None
+        self.fin_acked = threading.Event()
+        self.lifecycle = Lifecycle()
+        self.recv_thread = None
+        if sock is not None:
+            # Shared socket owned by a UDPListener, which feeds us via handle_packet and impairs it for us
+            self.sock = sock
+            return
+        self.sock = impaired_socket(local_addr, loss_prob, corrupt_prob, seed)
+        self.recv_thread = threading.Thread(target=self._recv_loop)
         self.recv_thread.daemon = True
         self.recv_thread.start()
 
-    def compute_checksum(self, data):
-        return hashlib.md5(data).hexdigest()
-
-    def make_packet(self, seq, ack, flags, payload):
-        header = f"{seq}|{ack}|{flags}|".encode()
-        checksum = self.compute_checksum(header + payload).encode()
-        return checksum + b"|" + header + payload
-
-    def parse_packet(self, packet):
-        parts = packet.split(b"|", 4)
-        if len(parts) < 5:
-            return None, None, None, None, None
-        checksum, seq, ack, flags, payload = parts
-        header_payload = b"|".join(parts[1:])
-        if checksum.decode() != self.compute_checksum(header_payload):
-            return None, None, None, None, None
-        return int(seq), int(ack), int(flags), payload
-
-    def _recv_acks(self):
+    def _recv_loop(self):
+        # Single reader for the socket: ACKs drive the sender, data goes to recv()
+        receiver = BatchReceiver(self.sock, BUFFER_SIZE)
         while True:
             try:
-                self.sock.settimeout(TIMEOUT)
-                packet, _ = self.sock.recvfrom(BUFFER_SIZE)
-                seq, ack, flags, _ = self.parse_packet(packet)
-                if flags & ACK:
-                    with self.lock:
-                        if self._in_window(self.base, ack):
-                            self.base = (ack + 1) % MAX_SEQ
-                            self.ack_event.set()
+                # Polled faster once closing, so TIME_WAIT ends on time, and woken for a delayed ACK
+                timeout = TIMEOUT if self.lifecycle.deadline is None else TICK
+                if self.ack_due is not None:
+                    timeout = min(timeout, max(self.ack_due - time.monotonic(), 0.001))
+                self.sock.settimeout(timeout)
+                packets = receiver.recv()
             except socket.timeout:
+                packets = []
+            except OSError:
+                break
+            for packet, addr in packets:
+                self.handle_packet(packet, addr)
+            now = time.monotonic()
+            self.flush_ack(now)
+            if self.lifecycle.expire(now):
+                # The connection is over, so a standalone engine's socket and this thread go with it
+                self.sock.close()
+                break
+
+    def handle_packet(self, packet, addr):
+        parsed = parse_packet(packet)
+        if parsed is None:
+            self.metrics.checksum_failures += 1
+            return
+        seq, ack, flags, window, payload = parsed
+        self.lifecycle.last_heard = time.monotonic()
+        if flags & SYN:
+            self._handle_syn(ack, flags, window, payload, addr)
+            return
+        if self.listening:
+            # Standalone server side: the handshake ACK, or data if that ACK was lost
+            self.connected.set()
+        # Client side: anything past the SYN-ACK means our cookie ACK got through
+        self.handshake.confirmed()
+        if flags & COOKIE:
+            # Server side: a duplicate handshake ACK
+            return
+        if flags & FIN:
+            self._handle_fin(flags, addr)
+        elif flags & ACK:
+            self._handle_ack(ack, window, payload)
+        else:
+            self._handle_data(seq, flags, payload, addr)
+
+    def _handle_syn(self, ack, flags, window, payload, addr):
+        self.peer_window = window
+        if flags & ACK:
+            # Re-ACK duplicate SYN-ACKs too, in case our first ACK was lost
+            self.sock.sendto(self.handshake.on_syn_ack(ack, payload, self._recv_window()), addr)
+            self.connected.set()
+        elif self.syn_ack is not None:
+            self.sock.sendto(self.syn_ack, addr)
+        elif self.listening:
+            # A plain SYN-ACK: with no listener there is no state to spare, and the SYN's data is declined
+            self.remote_addr = addr
+            self.sock.sendto(make_packet(0, NO_DATA_ACK, SYN | ACK, b"", window=self._recv_window(), conn_id=self.conn_id), addr)
+
+    def accept_early_data(self, payload):
+        # Server side: segment 0 came in a resumed SYN, and the SYN-ACK acknowledges it
+        self.metrics.segments_received += 1
+        self.recv_queue.put(payload)
+        self.expected_seq = 1
+
+    def _handle_fin(self, flags, addr):
+        if flags & ACK:
+            self.lifecycle.on_fin_ack()
+            self.fin_acked.set()
+            return
+        # Re-ACKed every time, in case our FIN-ACK was lost; only our receive side ends here
+        self.sock.sendto(make_packet(0, 0, FIN | ACK, b"", conn_id=self.conn_id), addr)
+        if self.lifecycle.on_fin():
+            self.recv_queue.put(b"")
+
+    def connect(self, early=b""):
+        # early is at most one segment; True if it rode in the SYN on a resumed session and the server took it
+        syn = self.handshake.syn(self._recv_window(), early)
+        sent_at = time.time()
+        self.sock.sendto(syn, self.remote_addr)
+        retries = 0
+        while not self.connected.wait(self.rtt.rto):
+            retries += 1
+            if retries > MAX_RETRIES:
+                # The engine's socket and thread close with the aborted connection
+                error = TimeoutError(f"no SYN-ACK after {MAX_RETRIES} retransmissions")
+                self.abort(error)
+                raise error
+            self.rtt.on_timeout()
+            self.sock.sendto(syn, self.remote_addr)
+            sent_at = None
+        if sent_at is not None:
+            self.rtt.sample(time.time() - sent_at)
+        if self.handshake.early_accepted:
+            self.base = self.next_seq = self.high_seq = 1
+        return self.handshake.early_accepted
+
+    def close(self):
+        # Shuts down our sending side; send() has already waited for our data to be ACKed. Returns once the FIN
+        # is acknowledged, and a standalone engine's thread then finishes the teardown in the background.
+        if not self.lifecycle.close():
+            return
+        # A delayed ACK still pending would trail our FIN, leaving the peer resending data we already have
+        self._ack_timer(self.remote_addr)
+        fin = make_packet(0, 0, FIN, b"", conn_id=self.conn_id)
+        for _ in range(MAX_FIN_RETRIES):
+            self.sock.sendto(fin, self.remote_addr)
+            if self.fin_acked.wait(min(self.rtt.rto, MAX_FIN_RTO)):
+                return
+            self.rtt.on_timeout()
+        self.abort(ConnectionAbortedError("FIN was never acknowledged"))
+
+    def abort(self, error):
+        # Gives up on the connection: readers see EOF and a blocked send() raises error
+        self.lifecycle.abort(error)
+        self.recv_queue.put(b"")
+        self.ack_event.set()
+        self.fin_acked.set()
+
+    def shutdown_read(self):
+        # Server side, for an idle connection: its handler reads EOF and closes as if the client had
+        self.recv_queue.put(b"")
+
+    def keepalive(self):
+        # A probe as in TCP: an empty segment just below base, which the peer already has and can only
+        # answer with a duplicate ACK. Only sent with nothing in flight, so base is all the peer has seen.
+        self.sock.sendto(make_packet((self.base - 1) % MAX_SEQ, 0, 0, b"", conn_id=self.conn_id), self.remote_addr)
+
+    def in_flight(self):
+        # high_seq rather than next_seq: after a go-back next_seq sits at base with data still out
+        return self.high_seq - self.base
+
+    def _handle_ack(self, ack, window, sack):
+        with self.lock:
+            if window > self.peer_window:
+                self.ack_event.set()
+            self.peer_window = window
+            # Measured against high_seq: after a go-back, a cumulative ACK can cover segments past next_seq
+            outstanding = self.high_seq - self.base
+            offset = (ack - self.base) % MAX_SEQ
+            if offset < outstanding:
+                acked = self.buffer.get(self.base + offset)
+                if acked is not None and not acked[2]:
+                    self.rtt.sample(time.time() - acked[1])
+                else:
+                    self.rtt.on_new_ack()
+                self.cc.on_ack(offset + 1)
+                for seq in range(self.base, self.base + offset + 1):
+                    self.buffer.pop(seq, None)
+                    self.sacked.discard(seq)
+                    self.rexmitted.discard(seq)
+                self.base += offset + 1
+                self.next_seq = max(self.next_seq, self.base)
+                self._record_sack(sack)
+                if self.sacked:
+                    # Partial ACK: the receiver still holds data past another hole
+                    self._retransmit_holes()
+                self.ack_event.set()
+            elif outstanding and offset == MAX_SEQ - 1:
+                # Receiver re-ACKed base - 1: something at base went missing
+                self.metrics.duplicate_acks += 1
+                self._record_sack(sack)
+                self.cc.on_dup_ack()
+                if self.cc.in_recovery():
+                    # In recovery every further duplicate may SACK past another hole
+                    self._retransmit_holes()
+                    self.ack_event.set()
+
+    def _record_sack(self, sack):
+        if not sack:
+            return
+        outstanding = self.high_seq - self.base
+        for start, end in unpack_sack(sack):
+            first = (start - self.base) % MAX_SEQ
+            last = (end - self.base) % MAX_SEQ
+            if first < last <= outstanding:
+                self.sacked.update(range(self.base + first, self.base + last))
+
+    def _retransmit_holes(self):
+        # Fast retransmit: resend only the unSACKed segments below the highest SACKed one
+        # (just base when the receiver sent no blocks), each once until the next timeout
+        top = max(self.sacked) if self.sacked else self.base + 1
+        packets = []
+        for seq in range(self.base, top):
+            entry = self.buffer.get(seq)
+            if entry is None or seq in self.sacked or seq in self.rexmitted:
                 continue
+            self.rexmitted.add(seq)
+            packets.append(entry[0])
+            self.buffer[seq] = (entry[0], time.time(), True)
+        send_batch(self.sock, packets, self.remote_addr)
+        self.metrics.segments_sent += len(packets)
+        self.metrics.retransmits += len(packets)
 
-    def _in_window(self, base, seq):
-        return (base <= seq < base + WINDOW_SIZE) or (base + WINDOW_SIZE >= MAX_SEQ and seq < (base + WINDOW_SIZE) % MAX_SEQ)
+    def _go_back(self):
+        # Rewind to base after a timeout; send() resends from there, skipping SACKed segments
+        self.buffer.clear()
+        self.rexmitted.clear()
+        self.next_seq = self.base
+
+    def _send_window(self):
+        return min(self.cc.window(), max(self.peer_window, 1))
+
+    def _recv_window(self):
+        return max(RECV_WINDOW - self.recv_queue.qsize(), 0)
+
+    def stats(self):
+        with self.lock:
+            stats = self.cc.stats()
+            stats.update(rto=self.rtt.rto, peer_window=self.peer_window, in_flight=self.in_flight())
+        stats.update(self.metrics.snapshot())
+        return stats
+
+    def _handle_data(self, seq, flags, payload, addr):
+        self.remote_addr = addr
+        self.metrics.segments_received += 1
+        with self.ack_lock:
+            offset = (seq - self.expected_seq) % MAX_SEQ
+            if offset == 0:
+                self.recv_queue.put(payload)
+                self.expected_seq += 1
+                filled = False
+                while self.expected_seq in self.ooo:
+                    self.recv_queue.put(self.ooo.pop(self.expected_seq))
+                    self.expected_seq += 1
+                    filled = True
+                self.unacked += 1
+                # Delayed ACK: every ACK_EVERY segments, at the end of a send (PSH) or on the timer;
+                # at once while a hole is open or was just filled, so the sender's recovery isn't held up
+                if self.unacked >= ACK_EVERY or flags & PSH or filled or self.ooo:
+                    self._send_ack(addr)
+                elif self.unacked == 1:
+                    self.ack_due = time.monotonic() + ACK_DELAY
+                return
+            if offset < RECV_WINDOW:
+                self.ooo.setdefault(self.expected_seq + offset, payload)
+            # Out of order, or an old duplicate because our ACK was lost: ACK now
+            self._send_ack(addr)
+
+    def flush_ack(self, now):
+        if self.ack_due is not None and now >= self.ack_due:
+            self._ack_timer(self.remote_addr)
+
+    def _ack_timer(self, addr):
+        with self.ack_lock:
+            if self.unacked:
+                self._send_ack(addr)
+
+    def _send_ack(self, addr):
+        # Cumulative ACK of the last in-order segment, with SACK blocks for what is held past it
+        self.unacked = 0
+        self.ack_due = None
+        sack = pack_sack(sack_blocks(self.ooo)) if self.ooo else b""
+        ack_packet = make_packet(0, (self.expected_seq - 1) % MAX_SEQ, ACK, sack, window=self._recv_window(), conn_id=self.conn_id)
+        self.sock.sendto(ack_packet, addr)
+        self.metrics.acks_sent += 1
 
     def send(self, data_list):
-        self.base = 0
-        self.next_seq = 0
-        self.buffer = {}
+        start = self.next_seq
+        end = start + len(data_list)
+        # Consecutive timeouts with base stuck; past MAX_RETRIES the peer is taken to be gone
+        retries, stuck_at = 0, self.base
 
-        while self.base < len(data_list):
+        while self.base < end:
+            if self.lifecycle.error is not None:
+                raise self.lifecycle.error
+            if self.base != stuck_at:
+                retries, stuck_at = 0, self.base
             with self.lock:
-                while self._in_window(self.base, self.next_seq) and self.next_seq < len(data_list):
-                    payload = data_list[self.next_seq]
-                    packet = self.make_packet(self.next_seq % MAX_SEQ, 0, 0, payload)
-                    self.buffer[self.next_seq % MAX_SEQ] = (packet, time.time())
-                    if random.random() > self.loss_prob:
-                        self.sock.sendto(packet, self.remote_addr)
+                # The whole window goes out in one batched send
+                packets = []
+                while self.next_seq < self.base + self._send_window() and self.next_seq < end:
+                    if self.next_seq in self.sacked:
+                        self.next_seq += 1
+                        continue
+                    payload = data_list[self.next_seq - start]
+                    flags = PSH if self.next_seq == end - 1 else 0
+                    packet = make_packet(self.next_seq % MAX_SEQ, 0, flags, payload, conn_id=self.conn_id)
+                    # Anything below high_seq was already sent once: no RTT sample from it
+                    resent = self.next_seq < self.high_seq
+                    self.buffer[self.next_seq] = (packet, time.time(), resent)
+                    packets.append(packet)
+                    self.metrics.segments_sent += 1
+                    self.metrics.retransmits += resent
                     self.next_seq += 1
+                send_batch(self.sock, packets, self.remote_addr)
+                self.high_seq = max(self.high_seq, self.next_seq)
+                self.metrics.window.observe(self.next_seq - self.base)
+                oldest = self.buffer[self.base][1] if self.base in self.buffer else time.time()
 
-            self.ack_event.wait(timeout=TIMEOUT)
+            self.ack_event.wait(timeout=max(0, oldest + self.rtt.rto - time.time()))
             self.ack_event.clear()
 
             with self.lock:
-                now = time.time()
-                for seq in list(self.buffer):
-                    pkt, ts = self.buffer[seq]
-                    if now - ts > TIMEOUT:
-                        if random.random() > self.loss_prob:
-                            self.sock.sendto(pkt, self.remote_addr)
-                        self.buffer[seq] = (pkt, time.time())
+                if self.base not in self.buffer:
+                    continue
+                _, ts, _ = self.buffer[self.base]
+                if time.time() - ts >= self.rtt.rto:
+                    retries += 1
+                    if retries > MAX_RETRIES:
+                        self.abort(ConnectionAbortedError(f"no ACK after {MAX_RETRIES} retransmissions"))
+                        continue
+                    if self.handshake.pending_ack is not None:
+                        # Nothing heard since the handshake: the server may never have got our cookie
+                        self.sock.sendto(self.handshake.pending_ack, self.remote_addr)
+                    self.metrics.timeouts += 1
+                    self.rtt.on_timeout()
+                    self.cc.on_timeout(self.in_flight())
+                    self._go_back()
+
+    def send_segments(self, segments):
+        self.send(segments)
 
     def recv(self):
-        expected_seq = 0
-        while True:
-            try:
-                packet, addr = self.sock.recvfrom(BUFFER_SIZE)
-                self.remote_addr = addr
-                seq, ack, flags, payload = self.parse_packet(packet)
-                if seq == expected_seq:
-                    ack_packet = self.make_packet(0, seq, ACK, b"")
-                    self.sock.sendto(ack_packet, addr)
-                    expected_seq = (expected_seq + 1) % MAX_SEQ
-                    return payload
-                else:
-                    # Always ACK last in-order packet
-                    ack_packet = self.make_packet(0, (expected_seq - 1) % MAX_SEQ, ACK, b"")
-                    self.sock.sendto(ack_packet, addr)
-            except socket.timeout:
-                continue
\ No newline at end of file
+        return self.recv_queue.get()
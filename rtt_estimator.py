@@ -0,0 +1,47 @@
+# Retransmission timeout estimation as in RFC 6298
+INITIAL_RTO = 1.0
+MIN_RTO = 0.05
+MAX_RTO = 60.0
+ALPHA = 1 / 8
+BETA = 1 / 4
+K = 4
+CLOCK_GRANULARITY = 0.001
+
+class RTTEstimator:
+    def __init__(self, initial_rto=INITIAL_RTO, min_rto=MIN_RTO, max_rto=MAX_RTO, histogram=None):
+        self.srtt = None
+        self.rttvar = None
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.base_rto = initial_rto
+        self.backoff = 1
+        # Optional transport_stats.Histogram that records every accepted sample
+        self.histogram = histogram
+
+    @property
+    def rto(self):
+        return min(self.base_rto * self.backoff, self.max_rto)
+
+    def sample(self, rtt):
+        # Callers must only pass samples from segments that were never
+        # retransmitted (Karn's algorithm); an ACK for a resent segment is ambiguous.
+        if self.histogram is not None:
+            self.histogram.observe(rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        rto = self.srtt + max(CLOCK_GRANULARITY, K * self.rttvar)
+        self.base_rto = min(max(rto, self.min_rto), self.max_rto)
+        self.backoff = 1
+
+    def on_new_ack(self):
+        # An ACK for a retransmitted segment gives no RTT sample, but it does
+        # show the path is delivering again, so the backoff can be dropped.
+        self.backoff = 1
+
+    def on_timeout(self):
+        if self.rto < self.max_rto:
+            self.backoff *= 2
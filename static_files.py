@@ -0,0 +1,203 @@
+import collections
+import email.utils
+import mimetypes
+import mmap
+import os
+import posixpath
+import threading
+import time
+import urllib.parse
+
+from http_message import status_line, render_headers
+
+CACHE_BYTES = 64 * 1024 * 1024  # total file bytes the response cache may hold
+REVALIDATE_INTERVAL = 1.0  # seconds a cached file is trusted before it is stat()ed again
+INDEX_FILE = "index.html"
+
+class FileEntry:
+    # One mapped file plus everything about its 200 response that doesn't change between requests
+    def __init__(self, fs_path, stat):
+        self.fs_path = fs_path
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.checked = time.monotonic()
+        self.etag = f'"{self.size:x}-{self.mtime_ns:x}"'
+        self.last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        self.content_type = mimetypes.guess_type(fs_path)[0] or "application/octet-stream"
+        self.body = self._map()
+        self.validators = [("ETag", self.etag), ("Last-Modified", self.last_modified)]
+        self.head = self.make_head(200, self.size)
+
+    def _map(self):
+        # Responses are memoryview slices of the mapping; the file is never read into the heap
+        if not self.size:
+            return b""
+        with open(self.fs_path, "rb") as f:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def make_head(self, status, length, extra=()):
+        # Everything but the Connection header and the blank line, which the server adds per request
+        fields = [("Content-Type", self.content_type), ("Content-Length", length), ("Accept-Ranges", "bytes")]
+        return status_line(status) + render_headers(fields + self.validators + list(extra))
+
+    def stale(self, stat):
+        return stat.st_size != self.size or stat.st_mtime_ns != self.mtime_ns
+
+def parse_range(value, size):
+    # A single "bytes=" range as (start, stop), stop exclusive; start >= size means unsatisfiable.
+    # None ignores the header: malformed and multi-range requests get the whole file, as RFC 9110 allows.
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash or not (first or last) or not (first + last).isdigit():
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        return (max(size - length, 0), size) if length else (size, size)
+    start = int(first)
+    stop = min(int(last) + 1, size) if last else size
+    if stop <= start and start < size:
+        return None
+    return start, stop
+
+def etag_matches(header, etag):
+    # If-None-Match uses the weak comparison: W/ prefixes are ignored
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+def normalize(path):
+    # Request target -> decoded URL path without query, fragment, dot segments or repeated slashes.
+    # None for a path no file can have, such as one with an encoded NUL byte.
+    path = urllib.parse.unquote(path.split("?", 1)[0].split("#", 1)[0])
+    if "\x00" in path:
+        return None
+    return posixpath.normpath("/" + path.lstrip("/"))
+
+class StaticFiles:
+    # Document-root handler for GET and HEAD, shared by the HTTP servers; thread-safe
+    def __init__(self, root, cache_bytes=CACHE_BYTES):
+        self.root = os.path.realpath(root)
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {"file_cache_hits": self.hits, "file_cache_misses": self.misses,
+                    "file_cache_entries": len(self.cache), "file_cache_bytes": self.cached_bytes}
+
+    def resolve(self, path):
+        # normalize()d URL path -> file under root, or None; anything that escapes root (.., symlinks) is refused
+        fs_path = os.path.realpath(os.path.join(self.root, path.lstrip("/")))
+        if fs_path != self.root and not fs_path.startswith(self.root + os.sep):
+            return None
+        if os.path.isdir(fs_path):
+            fs_path = os.path.join(fs_path, INDEX_FILE)
+        return fs_path if os.path.isfile(fs_path) else None
+
+    def lookup(self, path):
+        # Cached by normalized path, so /f?1, /f?2 or /./f can't each map the file again and flush the cache
+        path = normalize(path)
+        if path is None:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(path)
+            if entry is not None:
+                self.cache.move_to_end(path)
+                if now - entry.checked < REVALIDATE_INTERVAL:
+                    self.hits += 1
+                    return entry
+        if entry is not None:
+            try:
+                stat = os.stat(entry.fs_path)
+            except OSError:
+                stat = None
+            if stat is not None and not entry.stale(stat):
+                entry.checked = now
+                with self.lock:
+                    self.hits += 1
+                return entry
+            self._evict(path)
+        fs_path = self.resolve(path)
+        if fs_path is None:
+            return None
+        try:
+            entry = FileEntry(fs_path, os.stat(fs_path))
+        except OSError:
+            return None
+        with self.lock:
+            self.misses += 1
+            if entry.size <= self.cache_bytes:
+                self._evict_locked(path)
+                self.cache[path] = entry
+                self.cached_bytes += entry.size
+                while self.cached_bytes > self.cache_bytes:
+                    _, old = self.cache.popitem(last=False)
+                    self.cached_bytes -= old.size
+        return entry
+
+    def _evict(self, path):
+        with self.lock:
+            self._evict_locked(path)
+
+    def _evict_locked(self, path):
+        # The mapping is not closed here: a response may still be sending slices of it
+        old = self.cache.pop(path, None)
+        if old is not None:
+            self.cached_bytes -= old.size
+
+    def respond(self, method, path, headers):
+        # (head, body) for a GET or HEAD of path; headers are the request's, lowercased names.
+        # head lacks the Connection header and the terminating blank line.
+        entry = self.lookup(path)
+        if entry is None:
+            body = b"<html><body><h1>404 Not Found</h1></body></html>"
+            head = status_line(404) + render_headers([("Content-Type", "text/html"), ("Content-Length", len(body))])
+            return head, body if method != "HEAD" else b""
+
+        if self._not_modified(entry, headers):
+            return status_line(304) + render_headers(entry.validators), b""
+
+        head, body = entry.head, entry.body
+        byte_range = headers.get("range")
+        if byte_range is not None and self._range_applies(entry, headers):
+            span = parse_range(byte_range, entry.size)
+            if span is not None:
+                start, stop = span
+                if start >= entry.size:
+                    head = entry.make_head(416, 0, [("Content-Range", f"bytes */{entry.size}")])
+                    return head, b""
+                head = entry.make_head(206, stop - start, [("Content-Range", f"bytes {start}-{stop - 1}/{entry.size}")])
+                body = body[start:stop]
+        return head, body if method != "HEAD" else b""
+
+    def _not_modified(self, entry, headers):
+        # If-None-Match wins over If-Modified-Since when both are sent (RFC 9110 section 13.2.2)
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None:
+            return etag_matches(if_none_match, entry.etag)
+        if_modified_since = headers.get("if-modified-since")
+        if if_modified_since is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return entry.mtime_ns // 1_000_000_000 <= since
+
+    def _range_applies(self, entry, headers):
+        # If-Range: serve the range only if the client's copy is still current, else the whole file
+        if_range = headers.get("if-range")
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return if_range == entry.etag
+        return if_range == entry.last_modified
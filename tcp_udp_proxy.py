@@ -1,19 +1,175 @@
-import socket
-from reliable_udp_http import ReliableUDP
-
-def handle_browser_connection(tcp_conn, addr):
-    client_data = tcp_conn.recv(4096)
-    udp = ReliableUDP(('0.0.0.0', 0), ('localhost', 8080))
-    udp.send(client_data)
-    response = udp.recv()
-    tcp_conn.sendall(response)
-    tcp_conn.close()
-
-tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-tcp_socket.bind(('localhost', 9090))
-tcp_socket.listen(5)
-print("Proxy listening on TCP port 9090")
-
-while True:
-    conn, addr = tcp_socket.accept()
-    handle_browser_connection(conn, addr)
+import asyncio
+import argparse
+import collections
+import time
+
+from async_reliable_udp import open_connection
+from http_message import HTTPParser, HTTPParseError, finish_head, error_response, encode_chunk, LAST_CHUNK
+
+CHUNK_SIZE = 64 * 1024
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection"}
+
+def forwarded_head(message):
+    # Start line and end-to-end headers; framing headers stay, since the body is forwarded in its own framing
+    if message.method is not None:
+        start_line = f"{message.method} {message.target} {message.version}"
+    else:
+        start_line = f"{message.version} {message.status} {message.reason}"
+    drop = HOP_BY_HOP | set(message.tokens("connection"))
+    fields = [(name, value) for name, value in message.fields if name.decode("latin-1").lower() not in drop]
+    return start_line.encode("latin-1") + b"\r\n" + b"".join(name + b": " + value + b"\r\n" for name, value in fields)
+
+async def next_event(parser, reader):
+    while True:
+        event = parser.next_event()
+        if event is not None:
+            return event
+        data = await reader.read(CHUNK_SIZE)
+        if data:
+            parser.feed(data)
+        else:
+            parser.feed_eof()
+
+async def forward_body(parser, reader, writer, message):
+    # Stream the body as the parser releases it; chunked bodies are re-chunked, the rest passes through
+    while True:
+        kind, data = await next_event(parser, reader)
+        if kind == "end":
+            break
+        writer.write(b"".join(encode_chunk(data)) if message.chunked else data)
+        await writer.drain()
+    if message.chunked:
+        writer.write(LAST_CHUNK)
+        await writer.drain()
+
+class SessionPool:
+    # Established reliable-UDP sessions to the backend, reused across browser requests
+    def __init__(self, backend_addr, size=8, idle_timeout=30.0, loss_prob=0.0, connect_timeout=5.0):
+        self.backend_addr = backend_addr
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.loss_prob = loss_prob
+        self.idle = collections.deque()
+        self.slots = asyncio.Semaphore(size)
+
+    async def acquire(self):
+        await self.slots.acquire()
+        while self.idle:
+            reader, writer, _ = self.idle.pop()
+            if not writer.is_closing():
+                return reader, writer
+        try:
+            host, port = self.backend_addr
+            # Sooner than the handshake's own retry limit, so a browser isn't kept waiting on a dead backend
+            return await asyncio.wait_for(open_connection(host, port, loss_prob=self.loss_prob), self.connect_timeout)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, session, reusable):
+        reader, writer = session
+        if reusable and not writer.is_closing():
+            self.idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+        self.slots.release()
+
+    async def evict_idle(self):
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            now = time.monotonic()
+            while self.idle and now - self.idle[0][2] > self.idle_timeout:
+                _, writer, _ = self.idle.popleft()
+                writer.close()
+
+class TCPUDPProxy:
+    def __init__(self, pool, host='localhost', port=9090):
+        self.pool = pool
+        self.host = host
+        self.port = port
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.handle_browser_connection, self.host, self.port)
+        evictor = asyncio.get_running_loop().create_task(self.pool.evict_idle())
+        print(f"Proxy listening on TCP port {self.port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            evictor.cancel()
+
+    async def handle_browser_connection(self, tcp_reader, tcp_writer):
+        # One request parser per browser connection, so pipelined requests are read one at a time
+        parser = HTTPParser(max_body_bytes=None)
+        try:
+            while await self.forward_one(parser, tcp_reader, tcp_writer):
+                pass
+        except HTTPParseError as e:
+            print("[PROXY] Bad request:", e)
+            tcp_writer.write(error_response(e))
+        except ConnectionError as e:
+            print("[PROXY] Connection error:", e)
+        finally:
+            tcp_writer.close()
+
+    async def forward_one(self, parser, tcp_reader, tcp_writer):
+        kind, request = await next_event(parser, tcp_reader)
+        if kind == "closed":
+            return False
+
+        try:
+            session = await self.pool.acquire()
+        except (asyncio.TimeoutError, OSError) as e:
+            print("[PROXY] Backend unreachable:", str(e) or "handshake timed out")
+            tcp_writer.write(error_response(HTTPParseError(502, "Backend unreachable")))
+            return False
+        udp_reader, udp_writer = session
+        reusable = False
+        responding = False
+        try:
+            # Backend sessions are always persistent; the browser's Connection header only governs TCP
+            udp_writer.write(finish_head(forwarded_head(request), True))
+            await forward_body(parser, tcp_reader, udp_writer, request)
+            await udp_writer.drain()
+
+            response_parser = HTTPParser(response=True, max_body_bytes=None)
+            response_parser.expect_response(request.method)
+            try:
+                kind, response = await next_event(response_parser, udp_reader)
+                if kind == "closed":
+                    # A pooled session the backend has since closed; it isn't returned to the pool
+                    print("[PROXY] Backend closed the session before responding")
+                    tcp_writer.write(error_response(HTTPParseError(502, "Backend closed the connection")))
+                    return False
+                # A body read until the backend closes can't be delimited for a persistent browser connection
+                keep_alive = request.keep_alive and (response.length is not None or response.chunked)
+                responding = True
+                tcp_writer.write(finish_head(forwarded_head(response), keep_alive))
+                await forward_body(response_parser, udp_reader, tcp_writer, response)
+            except HTTPParseError as e:
+                print("[PROXY] Bad response from backend:", e)
+                if not responding:
+                    tcp_writer.write(error_response(HTTPParseError(502, str(e))))
+                return False
+            reusable = response.keep_alive and not response_parser.buffer
+            return keep_alive
+        finally:
+            self.pool.release(session, reusable)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9090, help="TCP port browsers connect to")
+    parser.add_argument("--backend-host", default="localhost")
+    parser.add_argument("--backend-port", type=int, default=8080)
+    parser.add_argument("--pool-size", type=int, default=8, help="Maximum concurrent backend sessions")
+    parser.add_argument("--idle-timeout", type=float, default=30.0, help="Seconds before an idle session is closed")
+    parser.add_argument("--loss", type=float, default=0.0, help="Packet loss probability on backend sessions")
+    parser.add_argument("--connect-timeout", type=float, default=5.0, help="Seconds to wait for a backend handshake")
+    args = parser.parse_args()
+
+    async def main():
+        pool = SessionPool((args.backend_host, args.backend_port), size=args.pool_size,
+                           idle_timeout=args.idle_timeout, loss_prob=args.loss, connect_timeout=args.connect_timeout)
+        await TCPUDPProxy(pool, port=args.port).serve_forever()
+
+    asyncio.run(main())
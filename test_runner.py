@@ -1,40 +1,64 @@
-import subprocess
+import argparse
+import threading
 import time
-import os
-import signal
 
-# Configurable packet loss and corruption for testing
-LOSS_PROB = 0.2
-CORRUPT_PROB = 0.2
+from reliable_udp_http import HTTPServer, HTTPClient
+from net_emulator import Impairments, ImpairmentRelay
+
+SERVER_PORT = 8080
+RELAY_PORT = 9000
+
+# name -> Impairments keyword arguments, applied to each direction of the relay
+SCENARIOS = {
+    "clean": {},
+    "lossy": {"loss": 0.1, "corrupt": 0.1},
+    "wan": {"delay": 0.04, "jitter": 0.01},
+    "reorder": {"delay": 0.01, "reorder": 0.2, "duplicate": 0.1},
+    "narrow": {"rate": 64 * 1024, "burst": 4096, "loss": 0.05},
+}
 
 def run_server():
-    # Start server process
-    return subprocess.Popen([
-        "python", "reliable_udp_http.py", "server",
-        "--loss", str(LOSS_PROB),
-        "--corrupt", str(CORRUPT_PROB)
-    ])
-
-def run_client():
-    time.sleep(2)  # Ensure server is ready
-    subprocess.run([
-        "python", "reliable_udp_http.py", "client",
-        "--loss", str(LOSS_PROB),
-        "--corrupt", str(CORRUPT_PROB)
-    ])
+    # Single-session server: returns once the client sends FIN
+    server = HTTPServer(port=SERVER_PORT, loss_prob=0, corrupt_prob=0)
+    server.serve_forever()
+    server.server.sock.close()
+
+def run_scenario(name, impairments, seed):
+    server_thread = threading.Thread(target=run_server)
+    server_thread.daemon = True
+    server_thread.start()
+    relay = ImpairmentRelay(('localhost', RELAY_PORT), ('localhost', SERVER_PORT),
+                            forward=Impairments(seed=seed, **impairments),
+                            reverse=Impairments(seed=seed + 1, **impairments))
+    relay_thread = relay.start()
+
+    start = time.time()
+    # The client's SYN retransmits until the server is listening, so no startup sleep is needed
+    client = HTTPClient(('localhost', RELAY_PORT), loss_prob=0, corrupt_prob=0)
+    responses = [client.get("/index.html"), client.post("/submit", "name=Project")]
+    client.client.close()
+    elapsed = time.time() - start
+
+    server_thread.join(timeout=10)
+    relay.close()
+    relay_thread.join()
+    client.client.sock.close()
+    ok = all(response is not None and response.startswith(b"HTTP/1.1 200 OK") for response in responses)
+    return ok, elapsed
 
 if __name__ == "__main__":
-    try:
-        server_proc = run_server()
-        run_client()
-    finally:
-        # Ensure server process is killed and socket is released
-        if server_proc.poll() is None:
-            print("[INFO] Terminating server process...")
-            if os.name == 'nt':  # Windows
-                server_proc.send_signal(signal.CTRL_BREAK_EVENT)
-            else:  # Linux/macOS
-                server_proc.terminate()
-            server_proc.wait()
-        print("[INFO] Server terminated. Waiting for port cleanup...")
-        time.sleep(1)  # Let OS fully release port
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=1, help="Emulator seed; the same seed replays the same impairments")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append",
+                        help="Scenario to run (repeatable, default: all)")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.scenario or SCENARIOS:
+        ok, elapsed = run_scenario(name, SCENARIOS[name], args.seed)
+        results.append((name, ok, elapsed))
+
+    for name, ok, elapsed in results:
+        print(f"[INFO] {name:<8} {'PASS' if ok else 'FAIL'} {elapsed:6.2f}s")
+    if not all(ok for _, ok, _ in results):
+        raise SystemExit(1)
@@ -0,0 +1,93 @@
+import bisect
+
+# Upper bounds; seconds for time histograms, segments for window occupancy
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+WINDOW_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+class Histogram:
+    def __init__(self, bounds=TIME_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def snapshot(self):
+        # Cumulative buckets, Prometheus style
+        buckets, running = [], 0
+        for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+            running += count
+            buckets.append((bound, running))
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+class ConnectionStats:
+    # Plain int attributes: the send/recv paths pay one increment each and take no lock.
+    # Two threads bumping the same counter can very rarely lose an increment; fine for metrics.
+    COUNTERS = ("segments_sent", "segments_received", "acks_sent", "retransmits", "checksum_failures",
+                "duplicate_acks", "timeouts")
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.rtt = Histogram(TIME_BUCKETS)
+        self.window = Histogram(WINDOW_BUCKETS)
+
+    def merge(self, other):
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.rtt.merge(other.rtt)
+        self.window.merge(other.window)
+
+    def snapshot(self):
+        stats = {name: getattr(self, name) for name in self.COUNTERS}
+        stats.update(rtt_seconds=self.rtt.snapshot(), window_occupancy=self.window.snapshot())
+        return stats
+
+def aggregate(connection_stats):
+    total = ConnectionStats()
+    for stats in connection_stats:
+        total.merge(stats)
+    return total
+
+def merge_snapshots(snapshots):
+    # Sum of stats() dicts from several processes: numbers add up, histograms bucket by bucket
+    total = {}
+    for snapshot in snapshots:
+        for name, value in snapshot.items():
+            if isinstance(value, dict) and "buckets" in value:
+                if name not in total:
+                    total[name] = {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]}
+                    continue
+                merged = total[name]
+                merged["buckets"] = [(bound, count + other) for (bound, count), (_, other)
+                                     in zip(merged["buckets"], value["buckets"])]
+                merged["sum"] += value["sum"]
+                merged["count"] += value["count"]
+            elif isinstance(value, (int, float)):
+                total[name] = total.get(name, 0) + value
+    return total
+
+def render_prometheus(stats, prefix="reliable_udp"):
+    # Text exposition format for the /metrics route; nested dicts that aren't histograms are skipped
+    lines = []
+    for name, value in sorted(stats.items()):
+        metric = f"{prefix}_{name}"
+        if isinstance(value, dict) and "buckets" in value:
+            lines.append(f"# TYPE {metric} histogram")
+            for bound, count in value["buckets"]:
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {count}')
+            lines.append(f"{metric}_sum {value['sum']}")
+            lines.append(f"{metric}_count {value['count']}")
+        elif isinstance(value, (int, float)):
+            lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
@@ -1,33 +1,68 @@
 
-from reliable_udp_sliding_window import ReliableUDP_GBN
+from udp_listener import ENGINES
+from reliable_stream import ReliableStream
 import argparse
 
 class HTTPClientGBN:
-    def __init__(self, server_addr, loss_prob=0.1, corrupt_prob=0.1):
-        self.client = ReliableUDP_GBN(('0.0.0.0', 0), server_addr, loss_prob=loss_prob, corrupt_prob=corrupt_prob)
+    def __init__(self, server_addr, loss_prob=0.1, corrupt_prob=0.1, mode="gbn", mss=None, seed=None):
+        self.client = ENGINES[mode](('0.0.0.0', 0), server_addr, loss_prob=loss_prob, corrupt_prob=corrupt_prob, seed=seed)
+        self.stream = ReliableStream(self.client, mss=mss)
+        # The handshake waits for the first request, which can then ride in the SYN on a resumed session
+        self.connected = False
+
+    def send(self, request, idempotent):
+        if self.connected:
+            self.stream.sendall(request)
+            return
+        self.connected = True
+        # A SYN can be replayed, so only requests that are safe to repeat go in one
+        if idempotent:
+            self.stream.connect(request)
+        else:
+            self.stream.connect()
+            self.stream.sendall(request)
+
+    def build_request(self, method, path, body="", content_type="text/plain"):
+        # HTTP/1.1 keeps the connection open, so every request reuses one established session
+        if method == "POST":
+            body = body.encode() if isinstance(body, str) else body
+            return (
+                f"POST {path} HTTP/1.1\r\n"
+                f"Host: localhost\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Content-Type: {content_type}\r\n\r\n"
+            ).encode() + body
+        return f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode()
 
     def get(self, path):
-        request = f"GET {path} HTTP/1.0\r\nHost: localhost\r\n\r\n"
-        self.client.send([request.encode()])
-        response = self.client.recv()
-        print("Received:\n", response.decode())
-
-    def post(self, path, body=""):
-        request = (
-            f"POST {path} HTTP/1.0\r\n"
-            f"Host: localhost\r\n"
-            f"Content-Length: {len(body)}\r\n"
-            f"Content-Type: text/plain\r\n\r\n{body}"
-        )
-        self.client.send([request.encode()])
-        response = self.client.recv()
-        print("Received:\n", response.decode())
+        self.send(self.build_request("GET", path), True)
+        response = self.stream.read_http_message(response=True)
+        print("Received:\n", response.decode(errors="replace"))
+
+    def post(self, path, body="", content_type="text/plain"):
+        self.send(self.build_request("POST", path, body, content_type), False)
+        response = self.stream.read_http_message(response=True)
+        print("Received:\n", response.decode(errors="replace"))
+
+    def pipeline(self, requests):
+        # Send every (method, path, body) request before reading any response; they share
+        # the GBN window, and the server answers in order so responses line up with requests
+        idempotent = all(method in ("GET", "HEAD") for method, _, _ in requests)
+        self.send(b"".join(self.build_request(*request) for request in requests), idempotent)
+        return [self.stream.read_http_message(response=True) for _ in requests]
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--loss", type=float, default=0.1)
     parser.add_argument("--corrupt", type=float, default=0.1)
+    parser.add_argument("--mode", choices=sorted(ENGINES), default="gbn", help="Go-Back-N or Selective Repeat")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the emulated loss/corruption")
+    parser.add_argument("--mss", type=int, default=None, help="Maximum segment size (default: derived from path MTU)")
     args = parser.parse_args()
-    client = HTTPClientGBN(('localhost', 8080), loss_prob=args.loss, corrupt_prob=args.corrupt)
+    client = HTTPClientGBN(('localhost', 8080), loss_prob=args.loss, corrupt_prob=args.corrupt, mode=args.mode, mss=args.mss,
+                           seed=args.seed)
     client.get("/index.html")
     client.post("/submit", "name=Project")
+    for response in client.pipeline([("GET", "/a.css", ""), ("GET", "/b.js", ""), ("POST", "/submit", "name=Pipelined")]):
+        print("Pipelined:\n", response.decode(errors="replace"))
+    client.client.close()
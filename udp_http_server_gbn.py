@@ -1,42 +1,128 @@
 
-from reliable_udp_sliding_window import ReliableUDP_GBN
+from udp_listener import UDPListener, ENGINES
+from reliable_stream import ReliableStream
+from transport_stats import Histogram, render_prometheus
+from static_files import StaticFiles
+from prefork import Supervisor
+from http_message import (HTTPParser, HTTPParseError, read_message, status_line, render_headers, finish_head,
+                          error_response)
 import argparse
+import functools
+import threading
+import time
 
 class HTTPServerGBN:
-    def __init__(self, host='localhost', port=8080, loss_prob=0.1, corrupt_prob=0.1):
-        self.server = ReliableUDP_GBN((host, port), loss_prob=loss_prob, corrupt_prob=corrupt_prob)
+    def __init__(self, host='localhost', port=8080, loss_prob=0.1, corrupt_prob=0.1, mode="gbn", mss=None,
+                 seed=None, root=None, sock=None):
+        self.mode = mode
+        # With a document root, GET/HEAD serve files from it; without one, pages are synthesized
+        self.files = StaticFiles(root) if root else None
+        self.mss = mss
+        self.listener = UDPListener((host, port), mode=mode, loss_prob=loss_prob, corrupt_prob=corrupt_prob, seed=seed,
+                                    sock=sock)
+        self.requests = 0
+        self.request_latency = Histogram()
+        # Set in a prefork worker, so /metrics reports the whole cluster rather than this process
+        self.cluster = None
+
+    def stats(self):
+        stats = self.listener.stats()
+        stats.update(requests=self.requests, request_latency_seconds=self.request_latency.snapshot())
+        if self.files is not None:
+            stats.update(self.files.stats())
+        return stats
 
     def serve_forever(self):
-        print("HTTP Server (GBN) started.")
+        print(f"HTTP Server ({self.mode.upper()}) started.")
+        while True:
+            conn = self.listener.accept()
+            handler = threading.Thread(target=self.handle_connection, args=(conn,))
+            handler.daemon = True
+            handler.start()
+
+    def handle_connection(self, conn):
+        stream = ReliableStream(conn, mss=self.mss)
+        # One parser per connection: it consumes segments as they arrive and keeps pipelined requests apart
+        parser = HTTPParser()
         while True:
             try:
-                data = self.server.recv()
-                request = data.decode()
-                lines = request.split('\r\n')
-                if not lines:
-                    continue
-                method_line = lines[0].split()
-                if len(method_line) < 2:
-                    continue
-                method, path = method_line[:2]
-                if method == 'GET':
-                    content = f"<html><body><h1>You requested {path}</h1></body></html>"
-                    status = "HTTP/1.0 200 OK"
-                elif method == 'POST':
-                    content = f"<html><body><h1>POST Received to {path}</h1></body></html>"
-                    status = "HTTP/1.0 200 OK"
-                else:
-                    content = "<html><body><h1>404 Not Found</h1></body></html>"
-                    status = "HTTP/1.0 404 Not Found"
-                response = f"{status}\r\nContent-Length: {len(content)}\r\nContent-Type: text/html\r\n\r\n{content}"
-                self.server.send([response.encode()])
+                try:
+                    request = read_message(parser, stream.read_some)
+                except HTTPParseError as e:
+                    stream.sendall(error_response(e))
+                    conn.close()
+                    break
+                if request is None:
+                    # The client shut down its side, or the listener reaped the connection: our FIN ends it
+                    conn.close()
+                    break
+                started = time.perf_counter()
+                keep_alive = request.keep_alive
+                try:
+                    head, body = self.respond(request)
+                except Exception as e:
+                    # e.g. a file that can't be read: answer and close rather than leave the client waiting
+                    print(f"[INFO] {request.method} {request.target} failed: {e!r}")
+                    stream.sendall(error_response(HTTPParseError(500, "Internal Server Error")))
+                    conn.close()
+                    break
+                stream.sendall_parts([finish_head(head, keep_alive), body])
+                # Requests on one connection run sequentially; across connections a rare lost increment is acceptable
+                self.requests += 1
+                self.request_latency.observe(time.perf_counter() - started)
+                if not keep_alive:
+                    conn.close()
+                    break
             except TimeoutError:
                 continue
+            except ConnectionError as e:
+                print(f"[INFO] Connection to {conn.remote_addr} aborted: {e}")
+                break
+
+    def respond(self, request):
+        # (head, body) for one request; head lacks the Connection header and the terminating blank line
+        method, path = request.method, request.target
+        content_type = "text/html"
+        if method == 'GET' and path == "/metrics":
+            content = render_prometheus(self.cluster.stats() if self.cluster is not None else self.stats())
+            content_type = "text/plain; version=0.0.4"
+            status = 200
+        elif self.files is not None and method in ('GET', 'HEAD'):
+            return self.files.respond(method, path, request.headers)
+        elif method == 'GET':
+            content = f"<html><body><h1>You requested {path}</h1></body></html>"
+            status = 200
+        elif method == 'POST':
+            content = f"<html><body><h1>POST Received to {path} ({len(request.body)} bytes)</h1></body></html>"
+            status = 200
+        else:
+            content = "<html><body><h1>404 Not Found</h1></body></html>"
+            status = 404
+        body = content.encode()
+        return status_line(status) + render_headers([("Content-Length", len(body)), ("Content-Type", content_type)]), body
+
+def run_worker(sock, cluster, seed=None, **kwargs):
+    # Prefork worker entry point; each worker gets its own emulator seed so they don't drop in lockstep
+    server = HTTPServerGBN(sock=sock, seed=None if seed is None else seed + cluster.index, **kwargs)
+    cluster.attach(server.stats)
+    cluster.run_publisher()
+    server.cluster = cluster
+    server.serve_forever()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--loss", type=float, default=0.1)
     parser.add_argument("--corrupt", type=float, default=0.1)
+    parser.add_argument("--mode", choices=sorted(ENGINES), default="gbn", help="Go-Back-N or Selective Repeat")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the emulated loss/corruption")
+    parser.add_argument("--mss", type=int, default=None, help="Maximum segment size (default: derived from path MTU)")
+    parser.add_argument("--root", default=None, help="Document root to serve files from")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes sharing the port via SO_REUSEPORT")
     args = parser.parse_args()
-    server = HTTPServerGBN(loss_prob=args.loss, corrupt_prob=args.corrupt)
-    server.serve_forever()
+    options = dict(loss_prob=args.loss, corrupt_prob=args.corrupt, mode=args.mode, mss=args.mss, seed=args.seed,
+                   root=args.root)
+    if args.workers > 1:
+        Supervisor(functools.partial(run_worker, **options), ('localhost', args.port), args.workers).serve_forever()
+    else:
+        HTTPServerGBN(port=args.port, **options).serve_forever()
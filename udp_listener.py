@@ -0,0 +1,185 @@
+import socket
+import threading
+import queue
+import time
+
+from packet_codec import make_packet, parse_packet, peek_conn_id
+from reliable_udp_sliding_window import ReliableUDP_GBN, BUFFER_SIZE, TIMEOUT, RECV_WINDOW, ACK_DELAY, SYN, ACK, FIN
+from reliable_udp_selective_repeat import ReliableUDP_SR
+from batched_io import BatchReceiver
+from net_emulator import impaired_socket, impair
+from transport_stats import aggregate
+from handshake import HandshakeKeys, OvertakenPackets, COOKIE, split_syn
+from lifecycle import TimerWheel, TIME_WAIT, TIME_WAIT_PERIOD, KEEPALIVE_IDLE, TICK, PROBE, IDLE, DEAD, ABORT
+
+ENGINES = {"gbn": ReliableUDP_GBN, "sr": ReliableUDP_SR}
+
+class UDPListener:
+    # Owns one UDP socket and demultiplexes it into per-connection engines
+    def __init__(self, local_addr, mode="gbn", loss_prob=0.1, corrupt_prob=0.1, seed=None, sock=None):
+        # Every connection shares this socket, so they all see the same emulated link;
+        # sock is an already bound one, e.g. a prefork worker's share of an SO_REUSEPORT group
+        if sock is not None:
+            self.sock = impair(sock, loss_prob, corrupt_prob, seed)
+        else:
+            self.sock = impaired_socket(local_addr, loss_prob, corrupt_prob, seed)
+        self.engine_cls = ENGINES[mode]
+        # (addr, conn_id) -> engine, established connections only: a half-open one lives in the client's cookie
+        self.connections = {}
+        self.keys = HandshakeKeys()
+        self.overtaken = OvertakenPackets()
+        # Every live connection has its keepalive/idle check here, and every TIME_WAIT key its expiry;
+        # a TIME_WAIT key keeps no engine, only its place in time_wait and in the wheel
+        self.wheel = TimerWheel()
+        self.time_wait = set()
+        # Engines owing a delayed ACK, flushed from the receive loop once due
+        self.delayed_acks = set()
+        self.accept_queue = queue.Queue()
+        # Counters of connections already torn down, so totals survive them leaving self.connections
+        self.closed_metrics = aggregate([])
+        self.accepted = 0
+        self.syn_cookies_sent = 0
+        self.zero_rtt_accepted = 0
+        self.invalid_cookies = 0
+        self.keepalive_timeouts = 0
+        self.idle_timeouts = 0
+        self.lock = threading.Lock()
+        self.recv_thread = threading.Thread(target=self._recv_loop)
+        self.recv_thread.daemon = True
+        self.recv_thread.start()
+
+    def _recv_loop(self):
+        receiver = BatchReceiver(self.sock, BUFFER_SIZE)
+        while True:
+            try:
+                # Timers fire from this thread: it wakes every tick while any are set, sooner for a delayed ACK
+                self.sock.settimeout(ACK_DELAY if self.delayed_acks else TICK if self.wheel else TIMEOUT)
+                packets = receiver.recv()
+            except socket.timeout:
+                packets = []
+            except OSError:
+                break
+            for packet, addr in packets:
+                self._dispatch(packet, addr)
+            now = time.monotonic()
+            for conn in list(self.delayed_acks):
+                conn.flush_ack(now)
+                if conn.ack_due is None:
+                    self.delayed_acks.discard(conn)
+            self.wheel.advance(now)
+
+    def _dispatch(self, packet, addr):
+        conn_id = peek_conn_id(packet)
+        if conn_id is None:
+            return
+        key = (addr, conn_id)
+        conn = self.connections.get(key)
+        if conn is None:
+            self._new_connection(key, packet)
+            return
+        conn.handle_packet(packet, addr)
+        if conn.ack_due is not None:
+            self.delayed_acks.add(conn)
+        if not conn.lifecycle.is_open():
+            self._retire(key, conn)
+
+    def _retire(self, key, conn):
+        self.delayed_acks.discard(conn)
+        with self.lock:
+            self.connections.pop(key, None)
+            self.closed_metrics.merge(conn.metrics)
+        if conn.lifecycle.state == TIME_WAIT:
+            self.time_wait.add(key)
+            self.wheel.schedule(key, TIME_WAIT_PERIOD, self.time_wait.discard)
+        else:
+            self.wheel.cancel(key)
+
+    def _check(self, key):
+        # Keepalive and idle housekeeping; also how a connection its handler closed or aborted is noticed
+        conn = self.connections.get(key)
+        if conn is None:
+            return
+        metrics = conn.metrics
+        action, delay = conn.lifecycle.check(time.monotonic(), metrics.segments_sent + metrics.segments_received,
+                                             conn.in_flight())
+        if action == PROBE:
+            conn.keepalive()
+        elif action == IDLE:
+            self.idle_timeouts += 1
+            conn.shutdown_read()
+        elif action in (DEAD, ABORT):
+            self.keepalive_timeouts += action == DEAD
+            conn.abort(conn.lifecycle.error)
+        if not conn.lifecycle.is_open():
+            self._retire(key, conn)
+        else:
+            self.wheel.schedule(key, delay, self._check)
+
+    def _new_connection(self, key, packet):
+        addr, conn_id = key
+        parsed = parse_packet(packet)
+        if parsed is None:
+            return
+        _, _, flags, window, payload = parsed
+        if flags & FIN and not flags & ACK:
+            # Retransmitted FIN for a connection we already tore down
+            self.sock.sendto(make_packet(0, 0, FIN | ACK, b"", conn_id=conn_id), addr)
+        elif flags & SYN and not flags & ACK:
+            ticket, early = split_syn(payload)
+            # A ticket alone buys nothing: without a request to answer, the client proves its address first
+            if not early or not self.keys.check_ticket(ticket, addr):
+                # Nothing is kept until the client echoes the cookie
+                self.syn_cookies_sent += 1
+                self.sock.sendto(self.keys.syn_ack(addr, conn_id, RECV_WINDOW, False), addr)
+                return
+            # Resumed session: established at once, with the request in the SYN as segment 0.
+            # The SYN-ACK goes out before the connection is handed over, so it can't trail the response.
+            self.zero_rtt_accepted += 1
+            conn = self._establish(key, window, accepted=True)
+            conn.accept_early_data(early)
+            self.sock.sendto(conn.syn_ack, addr)
+            self._accept(conn)
+        elif flags & COOKIE and flags & ACK:
+            if not self.keys.check_cookie(payload, addr, conn_id):
+                self.invalid_cookies += 1
+                return
+            conn = self._establish(key, window, accepted=False)
+            held = self.overtaken.release(key)
+            if held is not None:
+                conn.handle_packet(held, addr)
+            self._accept(conn)
+        elif not flags & (SYN | ACK) and key not in self.time_wait:
+            self.overtaken.hold(key, packet)
+
+    def _establish(self, key, window, accepted):
+        addr, conn_id = key
+        conn = self.engine_cls(None, addr, sock=self.sock, conn_id=conn_id)
+        conn.peer_window = window
+        conn.syn_ack = self.keys.syn_ack(addr, conn_id, RECV_WINDOW, accepted)
+        conn.connected.set()
+        self.connections[key] = conn
+        # A reused key ends its TIME_WAIT early, as a new SYN does in TCP; the check replaces its timer
+        self.time_wait.discard(key)
+        self.wheel.schedule(key, KEEPALIVE_IDLE, self._check)
+        return conn
+
+    def _accept(self, conn):
+        self.accepted += 1
+        self.accept_queue.put(conn)
+
+    def stats(self):
+        # Totals over every connection this listener has seen, live or closed
+        with self.lock:
+            live = list(self.connections.values())
+            stats = aggregate([self.closed_metrics] + [conn.metrics for conn in live]).snapshot()
+        stats.update(connections_active=len(live), connections_accepted=self.accepted,
+                     connections_time_wait=len(self.time_wait), syn_cookies_sent=self.syn_cookies_sent,
+                     zero_rtt_accepted=self.zero_rtt_accepted, invalid_cookies=self.invalid_cookies,
+                     keepalive_timeouts=self.keepalive_timeouts, idle_timeouts=self.idle_timeouts)
+        return stats
+
+    def accept(self):
+        return self.accept_queue.get()
+
+    def close(self):
+        self.sock.close()